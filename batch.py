@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+from main import (load_repository, get_function_prompt, get_caller_prompt, apply_replacements, get_function_check,
+                  get_caller_check, get_checked_response, update_call_sites, positive_int)
+from llm import get_llm_responses, llm_stats, print_llm_stats
+from parse_cache import ParseCache
+from gitapi import GitHubAPI, is_local_source
+from daemon import get_socket_path
+import metrics
+from call_context import get_callees, DEFAULT_CONTEXT_LINES, DEFAULT_TOKEN_BUDGET
+
+
+def load_jobs(job_file):
+    """
+    Load the jobs of a JSON job file, either a list of jobs or an object with a 'jobs' list.
+    Each job has the 'function' to modify (qualified or bare name) and either the 'parameter' to add with 'info' about
+    how it should affect the function, or a full 'prompt'.
+    """
+    with open(job_file, 'r', encoding='utf-8') as file:
+        jobs = json.load(file)
+    if isinstance(jobs, dict):
+        jobs = jobs['jobs']
+    return jobs
+
+
+def run_job(job, tree_dict, symbol_index, project_graph, max_attempts=3, concurrency=1, context_lines=DEFAULT_CONTEXT_LINES,
+            token_budget=DEFAULT_TOKEN_BUDGET, candidates=1):
+    """
+    Run one job: rewrite the function, then its callers, accepting only the code passing the checks
+    The callers are updated through their call sites, see update_job_call_sites, or with context_lines=None by
+    rewriting their whole code. Their calls must pass the added parameter.
+    max_attempts rounds of candidates responses are asked for at once, see get_checked_response
+    Returns the report of the job.
+    """
+    report = {'function': job['function'], 'status': None, 'attempts': 0, 'reason': None, 'callers': []}
+    symbols = symbol_index.lookup(job['function'])
+    if len(symbols) != 1:
+        report['status'] = 'not_found' if not symbols else 'ambiguous'
+        report['reason'] = [symbol['qualified_name'] for symbol in symbols] or None
+        return report
+    symbol = symbols[0]
+    report['function'] = qualified_name = symbol['qualified_name']
+    tree = tree_dict[symbol['file_path']]
+    function_code = tree.source.text(symbol['start_byte'], symbol['end_byte'])
+    prompt = job.get('prompt') or get_function_prompt(job['parameter'], job.get('info', ''), function_code)
+    response, report['attempts'], report['reason'] = get_checked_response(
+        prompt, get_function_check(symbol['name'], job.get('parameter')), max_attempts, candidates=candidates)
+    if report['reason'] is not None:
+        report['status'] = 'rejected'
+        return report
+    apply_replacements({symbol['file_path']: [(symbol['start_byte'], symbol['end_byte'], response)]},
+                       symbol_index, project_graph, tree_dict)
+
+    # update the callers, their code must keep their name and signature
+    symbol = symbol_index.lookup(qualified_name)[0]
+    function_def = tree_dict[symbol['file_path']].source.text(symbol['start_byte'], symbol['end_byte'])
+    if context_lines is not None:
+        report['callers'] = update_job_call_sites(qualified_name, tree_dict, symbol_index, project_graph, max_attempts,
+                                                  concurrency, context_lines, token_budget, job.get('parameter'), candidates)
+        report['status'] = 'applied'
+        return report
+    callers = [symbol_index.lookup(caller_name)[0] for caller_name in project_graph.get_callers(qualified_name)]
+    prompts = []
+    checks = []
+    for caller in callers:
+        caller_code = tree_dict[caller['file_path']].source.text(caller['start_byte'], caller['end_byte'])
+        prompts.append(get_caller_prompt(symbol['name'], function_def, caller_code))
+        callees = get_callees(caller['qualified_name'], qualified_name, tree_dict[caller['file_path']].source, project_graph)
+        checks.append(get_caller_check(caller, caller_code, symbol, function_def, job.get('parameter'), callees))
+
+    async def first_responses():
+        return {i: response async for i, response in get_llm_responses(prompts, concurrency)}
+
+    responses = asyncio.run(first_responses()) if prompts else {}
+    replacements = {}
+    for i, caller in enumerate(callers):
+        response, attempts, reason = get_checked_response(prompts[i], checks[i], max_attempts, 0, responses[i], candidates)
+        report['callers'].append({'function': caller['qualified_name'], 'status': 'applied' if reason is None else 'rejected',
+                                  'attempts': attempts, 'reason': reason})
+        if reason is None:
+            replacements.setdefault(caller['file_path'], []).append((caller['start_byte'], caller['end_byte'], response))
+    apply_replacements(replacements, symbol_index, project_graph, tree_dict)
+    report['status'] = 'applied'
+    return report
+
+
+def update_job_call_sites(qualified_name, tree_dict, symbol_index, project_graph, max_attempts=3, concurrency=1,
+                          context_lines=DEFAULT_CONTEXT_LINES, token_budget=DEFAULT_TOKEN_BUDGET, parameter=None, candidates=1):
+    """
+    Update the call sites of the function through update_call_sites, applying only the responses every call site of
+    their request is in and whose calls pass the added parameter and the required ones.
+    Returns the reports of the callers, a caller is applied if all its call sites are.
+    """
+    outcomes = {}
+
+    def get_response(i, request, check, response):
+        response, attempts, reason = get_checked_response(request['prompt'], check, max_attempts, 0, response, candidates)
+        outcomes[i] = (attempts, reason)
+        return response if reason is None else None
+
+    requests = update_call_sites(qualified_name, symbol_index, project_graph, tree_dict, get_response, concurrency,
+                                 context_lines, token_budget, parameter)
+    callers = {}
+    for i, request in enumerate(requests):
+        attempts, reason = outcomes[i]
+        for site in request['sites']:
+            for caller in site['callers']:
+                report = callers.setdefault(caller, {'function': caller, 'status': 'applied', 'attempts': 0, 'reason': None})
+                report['attempts'] = max(report['attempts'], attempts)
+                if reason is not None:
+                    report['status'] = 'rejected'
+                    report['reason'] = reason
+    return list(callers.values())
+
+
+def run_batch(directory, jobs, report_path=None, workers=None, cache=None, max_attempts=3, concurrency=1,
+              context_lines=DEFAULT_CONTEXT_LINES, token_budget=DEFAULT_TOKEN_BUDGET, daemon=None, candidates=1):
+    """
+    Load the repository once and run all the jobs on it, then write the JSON report
+    context_lines and token_budget shape the caller update prompts, see run_job
+    daemon is the socket of a daemon the indexes are loaded from, see load_repository
+    candidates is the number of responses asked for at once, see get_checked_response
+    """
+    start = time.perf_counter()
+    filepaths, tree_dict, symbol_index, project_graph = load_repository(directory, workers, cache, daemon)
+    load_time = time.perf_counter() - start
+    reports = []
+    for job in jobs:
+        job_start = time.perf_counter()
+        try:
+            reports.append(run_job(job, tree_dict, symbol_index, project_graph, max_attempts, concurrency, context_lines,
+                                   token_budget, candidates))
+        except Exception as e:
+            reports.append({'function': job.get('function'), 'status': 'error', 'reason': f"{type(e).__name__}: {e}"})
+        reports[-1]['elapsed'] = time.perf_counter() - job_start
+        print(f"{reports[-1]['function']}: {reports[-1]['status']}")
+    report = {
+        'repository': directory,
+        'files': len(filepaths),
+        'load_time': load_time,
+        'elapsed': time.perf_counter() - start,
+        'llm_calls': len(llm_stats),
+        'jobs': reports,
+    }
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the function updates listed in a job file without prompting.")
+    parser.add_argument('job_file', help="JSON file listing the jobs")
+    parser.add_argument('repo', help="path to the repository, or its url to clone it")
+    parser.add_argument('--report', default='report.json', help="path of the JSON report")
+    parser.add_argument('--workers', type=int, default=None, help="processes parsing the files, all the cores by default")
+    parser.add_argument('--concurrency', type=int, default=1, help="caller update requests sent to the llm at once")
+    parser.add_argument('--max-attempts', type=int, default=3, help="rounds of responses asked for before giving up on a function")
+    parser.add_argument('--candidates', type=positive_int, default=int(os.getenv("LLM_CANDIDATES", "1")),
+                        help="responses asked for at once in every round, the first one passing the checks is kept")
+    parser.add_argument('--no-cache', action='store_true', help="do not use the parse cache")
+    parser.add_argument('--context-lines', type=int, default=DEFAULT_CONTEXT_LINES,
+                        help="lines sent around every call site to update")
+    parser.add_argument('--token-budget', type=int, default=DEFAULT_TOKEN_BUDGET,
+                        help="tokens of a caller update request, the call sites of a file are grouped up to it")
+    parser.add_argument('--whole-callers', action='store_true',
+                        help="send the whole code of every caller in its own request instead of the call sites")
+    parser.add_argument('--fast', action='store_true',
+                        help="make or update a shallow sparse clone of the Python files through a local mirror, also for local paths")
+    parser.add_argument('--mirror-dir', default=None, help="directory of the mirrors of --fast, .git_mirrors by default")
+    parser.add_argument('--daemon', nargs='?', const='', default=None, metavar='SOCKET',
+                        help="load the indexes from the daemon watching the repository, on its default socket if none is given")
+    parser.add_argument('--trace', default=None, help="write the timings of every stage to this JSON file")
+    parser.add_argument('--metrics', default=None, help="write the stage metrics to this file in the Prometheus text format")
+    args = parser.parse_args()
+    if args.trace or args.metrics:
+        metrics.enable()
+
+    directory = args.repo
+    if args.fast:
+        sync = GitHubAPI(require_token=not is_local_source(args.repo)).sync_repo(args.repo, mirror_dir=args.mirror_dir)
+        if sync is None:
+            raise SystemExit(1)
+        directory = sync['path']
+    elif not os.path.isdir(directory):
+        directory = GitHubAPI().clone_repo(args.repo)
+    cache = None if args.no_cache else ParseCache()
+    daemon = None if args.daemon is None else args.daemon or get_socket_path(directory)
+    run_batch(directory, load_jobs(args.job_file), args.report, args.workers, cache, args.max_attempts, args.concurrency,
+              None if args.whole_callers else args.context_lines, args.token_budget, daemon, args.candidates)
+    if cache is not None:
+        cache.close()
+    print_llm_stats()
+    if args.trace:
+        metrics.write_trace(args.trace)
+    if args.metrics:
+        metrics.write_prometheus(args.metrics)
@@ -0,0 +1,66 @@
+import sys
+import time
+from construct_ast import CreateTree, FUNCTIONS_QUERY, PY_LANGUAGE
+
+# depths of the nested functions, from shallow to deep; the grammar cannot parse much more than 60 indentation levels
+DEPTHS = [1, 5, 10, 20, 40, 60]
+# the walk may take this many times longer per syntax node on the deepest code than on the shallowest
+MAX_SLOWDOWN = 2.0
+
+
+def nested_code(depth, width=20, calls=3):
+    """
+    Generate width classes, each holding a method with depth levels of nested functions making calls with non-ASCII arguments.
+    """
+    lines = []
+    for w in range(width):
+        lines.append(f"class Klasse{w}:")
+        for d in range(depth):
+            indent = '    ' * (d + 1)
+            lines.append(f"{indent}def f{w}_{d}(self, a):")
+            for c in range(calls):
+                lines.append(f"{indent}    g{c}(a, 'é日本{d}')")
+    return '\n'.join(lines) + '\n'
+
+
+def query_per_function(root):
+    """
+    Count the calls found by running the call query over the subtree of every function, the way the call graph
+    used to be built, which scans the body of a nested function again for each function around it.
+    """
+    calls_query = PY_LANGUAGE.query("(call) @call")
+    return sum(len(calls_query.captures(func)) for func, _ in FUNCTIONS_QUERY.captures(root))
+
+
+def measure(depth, runs=3):
+    """
+    Get the best parse time, single pass walk time and per function query time for code nested depth levels deep,
+    and the number of syntax nodes.
+    """
+    tree = CreateTree(nested_code(depth), 'nested.py')
+    if tree.parse_ast().root_node.has_error:
+        raise ValueError(f"The code nested {depth} levels deep does not parse")
+    parse = walk = query = float('inf')
+    for _ in range(runs):
+        start = time.perf_counter()
+        root = tree.parse_ast().root_node
+        parse = min(parse, time.perf_counter() - start)
+        start = time.perf_counter()
+        tree.get_function_entries(root)
+        walk = min(walk, time.perf_counter() - start)
+        start = time.perf_counter()
+        query_per_function(root)
+        query = min(query, time.perf_counter() - start)
+    return parse, walk, query, root.descendant_count
+
+
+if __name__ == "__main__":
+    print(f"{'depth':>5} {'nodes':>8} {'parse ms':>9} {'walk ms':>8} {'walk us/node':>12} {'query ms':>9}")
+    per_node = []
+    for depth in DEPTHS:
+        parse, walk, query, nodes = measure(depth)
+        per_node.append(walk / nodes)
+        print(f"{depth:>5} {nodes:>8} {parse * 1000:>9.1f} {walk * 1000:>8.1f} {walk / nodes * 1e6:>12.2f} {query * 1000:>9.1f}")
+    slowdown = per_node[-1] / per_node[0]
+    print(f"walk time per node, deepest vs shallowest: {slowdown:.2f}x (limit {MAX_SLOWDOWN}x)")
+    sys.exit(0 if slowdown <= MAX_SLOWDOWN else 1)
@@ -0,0 +1,341 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import builtins
+import argparse
+import platform
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+from construct_ast import CreateTree
+from code_editor import CodeEditor
+from symbol_index import SymbolIndex
+from project_graph import ProjectCallGraph
+from repo_scan import scan_python_files, parse_files
+import llm
+import main
+
+STAGES = ['scan', 'parse', 'call_graph', 'project_graph', 'symbol_lookup', 'get_function_from_name', 'edit', 'transform']
+# a stage regresses if it gets slower by more than this fraction and by more than MIN_SECONDS
+THRESHOLD = 0.2
+MIN_SECONDS = 0.002
+
+
+def function_lines(name, params, calls, indent, depth, text):
+    """
+    Get the lines of a function making the given calls, with depth levels of nested functions making the first of them.
+    """
+    pad = '    ' * indent
+    lines = [f"{pad}def {name}({params}):", f'{pad}    """{text} {name}"""']
+    for callee in calls:
+        lines.append(f"{pad}    {callee}(1, '{text}')")
+    if depth:
+        lines.extend(function_lines(f"inner_{depth}", "a, b=None", calls[:1], indent + 1, depth - 1, text))
+        lines.append(f"{pad}    inner_{depth}(a)")
+    lines.append(f"{pad}    return '{text}'")
+    return lines
+
+
+def generate_repository(directory, files=20, functions=20, calls=3, depth=1, non_ascii=True, seed=0):
+    """
+    Write a synthetic repository of files modules in packages of ten. Every module has functions functions, half of
+    them methods of a class, every fourth one with depth levels of nested functions. Each function makes calls calls
+    to functions of its module, to methods of its class and to functions imported from earlier modules.
+    With non_ascii the strings and one function name in five are not ASCII.
+    Returns the qualified names of the top level functions and methods.
+    """
+    rng = random.Random(seed)
+    text = 'é日本 ü' if non_ascii else 'abc'
+    qualified_names = []
+    exported = []
+    for i in range(files):
+        package = f"pkg{i // 10}"
+        os.makedirs(os.path.join(directory, package), exist_ok=True)
+        init_path = os.path.join(directory, package, '__init__.py')
+        if not os.path.exists(init_path):
+            open(init_path, 'w', encoding='utf-8').close()
+        names = [f"café_{i}_{k}" if non_ascii and k % 5 == 0 else f"func_{i}_{k}" for k in range(functions)]
+        plain, methods = names[:(functions + 1) // 2], names[(functions + 1) // 2:]
+        imported = rng.sample(exported, min(len(exported), 3))
+        lines = [f"from {module} import {name}" for module, name in imported] + ['']
+        for k, name in enumerate(plain):
+            callees = [rng.choice(plain[:k] + [imported_name for _, imported_name in imported] or ['print'])
+                       for _ in range(calls)]
+            lines.extend(function_lines(name, "a, b=None", callees, 0, depth if k % 4 == 0 else 0, text) + [''])
+            qualified_names.append(f"{package}.mod{i}.{name}")
+        if methods:
+            lines.append(f"class Service{i}:")
+            for k, name in enumerate(methods):
+                callees = [rng.choice([f"self.{method}" for method in methods[:k]] + plain) for _ in range(calls)]
+                lines.extend(function_lines(name, "self, a, b=None", callees, 1, depth if k % 4 == 0 else 0, text) + [''])
+                qualified_names.append(f"{package}.mod{i}.Service{i}.{name}")
+        with open(os.path.join(directory, package, f"mod{i}.py"), 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines))
+        exported.extend((f"{package}.mod{i}", name) for name in plain)
+    return qualified_names
+
+
+def time_stage(function, repeat, setup=None):
+    """
+    Run setup (untimed) then function repeat times and get the times of the runs and the last result.
+    function gets the result of setup if there is one.
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        args = (setup(),) if setup is not None else ()
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def build_project_graph(directory, records):
+    """
+    Index the records and build the project call graph from them.
+    """
+    symbol_index = SymbolIndex(directory)
+    for record in records:
+        symbol_index.update_file(record)
+    project_graph = ProjectCallGraph(symbol_index)
+    project_graph.update_files(records)
+    return symbol_index, project_graph
+
+
+def edit_functions(directory, filepaths, symbol_index):
+    """
+    Replace the first function of each file through CodeEditor.replace_code and update its tree incrementally.
+    """
+    trees = {}
+    for filepath in filepaths:
+        with open(filepath, 'r', encoding='utf-8') as file:
+            trees[filepath] = CreateTree(file.read(), filepath)
+        trees[filepath].call_graph()
+    start = time.perf_counter()
+    for filepath in filepaths:
+        tree = trees[filepath]
+        symbol = symbol_index.symbols[symbol_index.by_file[filepath][0]]
+        start_point = tree.source.byte_offset_to_point(symbol['start_byte'])
+        end_point = tree.source.byte_offset_to_point(symbol['end_byte'])
+        new_code = f"def {symbol['name']}(a, b=None, level=0):\n    print('é', level)\n    return {symbol['name']}(a)"
+        edit = CodeEditor(filepath).replace_code(start_point, end_point, new_code)
+        with open(filepath, 'r', encoding='utf-8') as file:
+            tree.update_tree(file.read(), edit)
+    return time.perf_counter() - start
+
+
+class EditingLLMClient(llm.FakeLLMClient):
+    """
+    FakeLLMClient doing the edits of the transform stage so its responses pass the checks of main: it adds a 'level'
+    parameter to the function and passes it at every call site of the generated repository, fencing the code of every
+    call site on its own like the llm often does.
+    """
+    def invoke(self, prompt, on_token=None):
+        response, input_tokens, _ = super().invoke(prompt)
+        match = re.search(r"Update the calls to (\S+) in", prompt)
+        if match is None:
+            # the first line of a generated function is its def, e.g. def func_0_1(a, b=None):
+            response = response.replace('):', ', level=None):', 1)
+        else:
+            call = re.compile(rf"\s*(\w+\.)*{re.escape(match.group(1))}\(.*\)$")
+            lines = []
+            for line in response.split('\n'):
+                if line.startswith('### Call site'):
+                    lines.extend(['```'] if lines else [])
+                    lines.extend([line, '```python'])
+                else:
+                    lines.append(line[:-1] + ", level='INFO')" if call.match(line) else line)
+            response = '\n'.join(lines + ['```'])
+        if on_token is not None:
+            on_token(response)
+        return response, input_tokens, len(response.split())
+
+
+def run_transform(directory, function_name, workers, concurrency):
+    """
+    Run main.transform without the graphs, answering its questions with function_name and approving every response.
+    Raises a RuntimeError if a response of the fake llm fails the checks, the stage would then time rejections.
+    """
+    def answer(prompt=''):
+        if prompt.startswith('Name of function'):
+            return function_name
+        if prompt.startswith('Parameter'):
+            return 'level'
+        if prompt.startswith('Info'):
+            return 'be printed'
+        return 'y'
+
+    original_input = builtins.input
+    builtins.input = answer
+    output = io.StringIO()
+    try:
+        with redirect_stdout(output):
+            main.transform(directory, workers, None, concurrency, draw=False)
+    finally:
+        builtins.input = original_input
+    rejected = [line for line in output.getvalue().splitlines() if line.startswith(('Rejected', 'Skipping'))]
+    if rejected:
+        raise RuntimeError(f"The responses of the fake llm failed the checks: {rejected[0]}")
+
+
+def get_commit():
+    """
+    Get the short hash of the checked out commit of this tool, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(config, stages=STAGES):
+    """
+    Generate the synthetic repository described by config and time the given stages on it.
+    Returns the results: the commit, the config and, for every stage, its best and mean time in seconds, the time of
+    every run and the number of operations it timed.
+    """
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    source = os.path.join(workdir, 'repo')
+    llm.set_llm_client(EditingLLMClient(latency=config['latency']))
+    # every response is computed by the fake, never served from the response cache
+    llm.response_cache = None
+    os.environ['LLM_CACHE'] = 'off'
+    results = {}
+    try:
+        qualified_names = generate_repository(source, config['files'], config['functions'], config['calls'],
+                                              config['depth'], config['non_ascii'], config['seed'])
+
+        def copy_repository():
+            target = os.path.join(workdir, 'run')
+            shutil.rmtree(target, ignore_errors=True)
+            shutil.copytree(source, target)
+            return target
+
+        def record(stage, times, ops):
+            results[stage] = {'seconds': min(times), 'mean': sum(times) / len(times), 'runs': times, 'ops': ops}
+
+        repeat = config['repeat']
+        times, filepaths = time_stage(lambda: scan_python_files(source), repeat)
+        record('scan', times, len(filepaths))
+        times, records = time_stage(lambda: parse_files(filepaths, config['workers']), repeat)
+        record('parse', times, len(filepaths))
+        codes = {}
+        for filepath in filepaths:
+            with open(filepath, 'r', encoding='utf-8') as file:
+                codes[filepath] = file.read()
+        if 'call_graph' in stages or 'get_function_from_name' in stages:
+            def build_call_graphs():
+                built = []
+                for filepath, code in codes.items():
+                    tree = CreateTree(code, filepath)
+                    tree.call_graph()
+                    built.append(tree)
+                return built
+            times, trees = time_stage(build_call_graphs, repeat)
+            record('call_graph', times, len(trees))
+        times, (symbol_index, project_graph) = time_stage(lambda: build_project_graph(source, records), repeat)
+        record('project_graph', times, len(symbol_index.symbols))
+        if 'symbol_lookup' in stages:
+            names = qualified_names + [name.rsplit('.', 1)[1] for name in qualified_names]
+            times, _ = time_stage(lambda: [symbol_index.lookup(name) for name in names], repeat)
+            record('symbol_lookup', times, len(names))
+        if 'get_function_from_name' in stages:
+            lookups = [(tree, name) for tree in trees for name in tree.graph.nodes() if tree.graph.is_function(name)]
+            times, _ = time_stage(lambda: [tree.get_function_from_name(name) for tree, name in lookups], repeat)
+            record('get_function_from_name', times, len(lookups))
+        if 'edit' in stages:
+            times = []
+            for _ in range(repeat):
+                target = copy_repository()
+                target_paths = [os.path.join(target, os.path.relpath(path, source)) for path in filepaths]
+                edited = [path for path in target_paths if not path.endswith('__init__.py')]
+                index, _ = build_project_graph(target, parse_files(edited, 1))
+                times.append(edit_functions(target, edited, index))
+            record('edit', times, len(edited))
+        if 'transform' in stages:
+            # the function with the most callers, so transform has to update as many of them as possible
+            function_name = max(symbol_index.symbols, key=lambda name: (len(project_graph.get_callers(name)), name))
+            times, _ = time_stage(lambda target: run_transform(target, function_name, config['workers'],
+                                                               config['concurrency']), repeat, copy_repository)
+            record('transform', times, len(project_graph.get_callers(function_name)) + 1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'config': config,
+        'stages': {stage: results[stage] for stage in STAGES if stage in stages and stage in results},
+    }
+
+
+def compare_results(base, new, threshold=THRESHOLD, min_seconds=MIN_SECONDS):
+    """
+    Print the best time of every stage in the base and new results and flag the stages that got slower by more than
+    threshold (a fraction) and more than min_seconds.
+    Returns the names of the regressed stages.
+    """
+    if base['config'] != new['config']:
+        print("Warning: the results were measured with different configurations")
+    print(f"{'stage':<24} {base.get('commit') or 'base':>12} {new.get('commit') or 'new':>12} {'change':>8}")
+    regressions = []
+    for stage, result in new['stages'].items():
+        if stage not in base['stages']:
+            continue
+        before, after = base['stages'][stage]['seconds'], result['seconds']
+        change = (after - before) / before if before else 0.0
+        regressed = change > threshold and after - before > min_seconds
+        if regressed:
+            regressions.append(stage)
+        print(f"{stage:<24} {before:>11.4f}s {after:>11.4f}s {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def print_results(results):
+    """
+    Print the best time of every stage and its time per operation.
+    """
+    for stage, result in results['stages'].items():
+        per_op = result['seconds'] / result['ops'] * 1e6 if result['ops'] else 0.0
+        print(f"{stage:<24} {result['seconds']:>9.4f}s  {result['ops']:>7} ops  {per_op:>10.1f} us/op")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the stages of the tool on a synthetic repository, or compare two results.")
+    parser.add_argument('--files', type=int, default=50, help="python modules in the repository")
+    parser.add_argument('--functions', type=int, default=20, help="functions per module")
+    parser.add_argument('--calls', type=int, default=3, help="calls made by every function")
+    parser.add_argument('--depth', type=int, default=2, help="levels of nested functions in every fourth function")
+    parser.add_argument('--ascii', action='store_true', help="only ASCII names and strings")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generator")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the fake llm takes per response")
+    parser.add_argument('--concurrency', type=int, default=1, help="caller update requests sent to the llm at once")
+    parser.add_argument('--workers', type=int, default=None, help="processes parsing the files, all the cores by default")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of every stage, the best one is kept")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help="stages to time")
+    parser.add_argument('--output', default='benchmark.json', help="JSON file the results are written to")
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help="compare two result files instead")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help="slowdown flagged as a regression, e.g. 0.2 for 20%%")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0], 'r', encoding='utf-8') as file:
+            base = json.load(file)
+        with open(args.compare[1], 'r', encoding='utf-8') as file:
+            new = json.load(file)
+        sys.exit(1 if compare_results(base, new, args.threshold) else 0)
+
+    config = {
+        'files': args.files, 'functions': args.functions, 'calls': args.calls, 'depth': args.depth,
+        'non_ascii': not args.ascii, 'seed': args.seed, 'latency': args.latency, 'concurrency': args.concurrency,
+        'workers': args.workers, 'repeat': args.repeat,
+    }
+    results = run_benchmarks(config, args.stages)
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print_results(results)
@@ -0,0 +1,236 @@
+import os
+import re
+import textwrap
+
+# rough size of a token, used to keep the prompts under the token budget
+CHARS_PER_TOKEN = 4
+# lines shown around every call site
+DEFAULT_CONTEXT_LINES = 3
+DEFAULT_TOKEN_BUDGET = 2000
+# marker of the code to rewrite, after the context of the call sites
+CALL_SITES_MARKER = "Call sites-\n"
+SITE_HEADER = re.compile(r"^\s*#+\s*Call site (\d+)\b.*$", re.MULTILINE)
+# the callee of a call in the project call graph is a dotted name, see ProjectCallGraph.resolve_callee
+CALLEE = re.compile(r"[\w.\s]+?(?=\s*\()")
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of tokens of the text.
+    """
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def get_line_span(source, start_byte, end_byte):
+    """
+    Get the first and last row of the lines holding the byte range of a SourceBuffer.
+    """
+    first = source.byte_offset_to_point(start_byte).row
+    last = source.byte_offset_to_point(max(start_byte, end_byte - 1)).row
+    return first, last
+
+
+def get_line_end(source, row):
+    """
+    Get the byte offset of the end of the row of a SourceBuffer, before its line break.
+    """
+    if row + 1 < len(source.line_starts):
+        return source.line_starts[row + 1] - 1
+    return len(source.data)
+
+
+def get_lines(source, first, last):
+    """
+    Get the text of the rows first to last of a SourceBuffer, without the final line break.
+    """
+    if first > last:
+        return ''
+    return source.text(source.line_starts[first], get_line_end(source, last))
+
+
+def get_callee(source, start_byte, end_byte):
+    """
+    Get the callee expression of the call at the byte range of a SourceBuffer, e.g. 'lg' or 'logger.log', without
+    whitespace.
+    """
+    match = CALLEE.match(source.text(start_byte, end_byte))
+    return re.sub(r"\s+", '', match.group(0)) if match else None
+
+
+def get_callees(caller, qualified_name, source, project_graph):
+    """
+    Get the callee expressions the caller calls the function through, from the SourceBuffer of its file at the calls
+    recorded in the project call graph.
+    """
+    callees = []
+    for start_byte, end_byte in project_graph.get_call_ranges(caller, qualified_name):
+        callee = get_callee(source, start_byte, end_byte)
+        if callee is not None and callee not in callees:
+            callees.append(callee)
+    return callees
+
+
+def get_calls_pattern(callees):
+    """
+    Get the regex matching a call through one of the callee expressions.
+    """
+    names = [r"\s*\.\s*".join(re.escape(part) for part in callee.split('.')) for callee in callees]
+    return re.compile(rf"(?<![\w.])(?:{'|'.join(names)})\s*\(")
+
+
+def get_call_sites(qualified_name, symbol_index, project_graph, tree_dict, context_lines=DEFAULT_CONTEXT_LINES):
+    """
+    Get the call sites of the function in every file, from the byte ranges of the calls in the project call graph.
+    A call site covers the whole lines of one or more calls, the calls whose lines overlap are merged into one.
+    Returns, for every file path, its call sites in file order: the byte range to rewrite, from the first character
+    of its first line to the end of its last line, its 'indent', 'code' and 'line', the 'before' and 'after' context
+    lines, the 'callers' it belongs to and the 'callees' expressions its calls go through, see get_callee.
+    """
+    sites_by_file = {}
+    for caller in project_graph.get_callers(qualified_name):
+        symbols = symbol_index.lookup(caller)
+        if not symbols:
+            continue
+        file_path = symbols[0]['file_path']
+        source = tree_dict[file_path].source
+        for start_byte, end_byte in project_graph.get_call_ranges(caller, qualified_name):
+            first, last = get_line_span(source, start_byte, end_byte)
+            callee = get_callee(source, start_byte, end_byte)
+            sites_by_file.setdefault(file_path, []).append([first, last, [caller], [callee] if callee else []])
+
+    call_sites = {}
+    for file_path, spans in sites_by_file.items():
+        source = tree_dict[file_path].source
+        merged = []
+        for first, last, callers, callees in sorted(spans):
+            if merged and first <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], last)
+                merged[-1][2].extend(caller for caller in callers if caller not in merged[-1][2])
+                merged[-1][3].extend(callee for callee in callees if callee not in merged[-1][3])
+            else:
+                merged.append([first, last, callers, callees])
+        sites = []
+        for first, last, callers, callees in merged:
+            code = get_lines(source, first, last)
+            indent = code[:len(code) - len(code.lstrip())]
+            sites.append({
+                'file_path': file_path,
+                'start_byte': source.line_starts[first] + len(indent.encode('utf-8')),
+                'end_byte': get_line_end(source, last),
+                'line': first + 1,
+                'indent': indent,
+                'code': code,
+                'before': get_lines(source, max(0, first - context_lines), first - 1),
+                'after': get_lines(source, last + 1, min(len(source.line_starts) - 1, last + context_lines)),
+                'callers': callers,
+                'callees': callees,
+            })
+        call_sites[file_path] = sites
+    return call_sites
+
+
+def get_call_sites_prompt(function_name, function_def, file_path, sites):
+    """
+    Get the prompt asking the llm to update the given call sites of one file to the new function definition.
+    The context of every call site comes first, with a placeholder for its lines, then the lines to rewrite under
+    numbered headers in the format the response must follow.
+    """
+    contexts = []
+    code = []
+    for number, site in enumerate(sites, 1):
+        context = [f"### Context of call site {number} (line {site['line']})"]
+        context += [site['before']] if site['before'] else []
+        context += [f"{site['indent']}[call site {number}]"] + ([site['after']] if site['after'] else [])
+        contexts.append('\n'.join(context))
+        code.append(f"### Call site {number}\n{site['code']}")
+    return (
+        f"The function definition for {function_name} has changed to the following:\n{function_def}\n"
+        f"Update the calls to {function_name} in {file_path} to reflect the changes in the function definition and to pass "
+        f"the argument properly to {function_name} function. The lines around each call site are shown for context only.\n"
+        + '\n'.join(contexts) + '\n'
+        + "Return every call site below under its '### Call site N' header with its lines updated, keeping their indentation. "
+        "Only return the updated call sites, without the context lines or any explanation.\n"
+        + CALL_SITES_MARKER + '\n'.join(code)
+    )
+
+
+def group_call_sites(function_name, function_def, call_sites, token_budget=DEFAULT_TOKEN_BUDGET, root=None):
+    """
+    Pack the call sites of every file into as few requests as possible, each one under token_budget tokens.
+    A call site too large for the budget gets a request of its own.
+    root is the directory the file paths are shown relative to.
+    Returns the requests: their 'file_path', 'sites' and 'prompt'.
+    """
+    empty = estimate_tokens(get_call_sites_prompt('', '', '', []))
+    requests = []
+    for file_path, sites in call_sites.items():
+        shown_path = os.path.relpath(file_path, root) if root else file_path
+        base = estimate_tokens(get_call_sites_prompt(function_name, function_def, shown_path, []))
+        groups = [[]]
+        tokens = base
+        for site in sites:
+            site_tokens = estimate_tokens(get_call_sites_prompt('', '', '', [site])) - empty
+            if groups[-1] and tokens + site_tokens > token_budget:
+                groups.append([])
+                tokens = base
+            groups[-1].append(site)
+            tokens += site_tokens
+        requests.extend({'file_path': file_path, 'sites': group,
+                         'prompt': get_call_sites_prompt(function_name, function_def, shown_path, group)}
+                        for group in groups if group)
+    return requests
+
+
+def parse_call_sites_response(response, count):
+    """
+    Get the code of every numbered call site of the llm response, indexed from 0.
+    The call sites missing from the response, or numbered beyond count, are left out.
+    """
+    if CALL_SITES_MARKER in response:
+        response = response.rsplit(CALL_SITES_MARKER, 1)[1]
+    parts = SITE_HEADER.split(response)
+    codes = {}
+    # split gives the text before the first header, then every header number followed by its text
+    for number, code in zip(parts[1::2], parts[2::2]):
+        number = int(number) - 1
+        # drop the code fences the llm may wrap the call sites in
+        code = '\n'.join(line for line in code.split('\n') if not line.strip().startswith('```')).strip('\n')
+        if 0 <= number < count and code.strip() and number not in codes:
+            codes[number] = code.rstrip()
+    return codes
+
+
+def reindent(code, indent):
+    """
+    Move the lines of the code to the given indentation, keeping their relative indentation, and drop the indentation
+    of the first line which is kept in the file.
+    """
+    lines = textwrap.dedent(code).splitlines()
+    return '\n'.join((indent + line if line.strip() else '') for line in lines)[len(indent):]
+
+
+def get_call_site_replacements(request, response, function_name, check=None):
+    """
+    Map the llm response to a request back to (start_byte, end_byte, code) replacements of its call sites.
+    A call site is skipped if the response misses it or its code no longer calls the function through the callee
+    expressions recorded at the site, e.g. an alias of the function or its class for a constructor, or if check, given
+    the dedented code of the call site and those callee expressions, returns the reason it is rejected.
+    Returns the replacements and the reasons the skipped call sites were rejected.
+    """
+    codes = parse_call_sites_response(response, len(request['sites']))
+    replacements = []
+    rejected = []
+    for number, site in enumerate(request['sites']):
+        code = codes.get(number)
+        if code is None:
+            reason = "is missing from the response"
+        elif not get_calls_pattern(site['callees'] or [function_name]).search(code):
+            reason = f"does not call {function_name} anymore"
+        else:
+            reason = check(textwrap.dedent(code), site['callees'] or [function_name]) if check is not None else None
+            reason = reason and f"is rejected as {reason}"
+        if reason is None:
+            replacements.append((site['start_byte'], site['end_byte'], reindent(code, site['indent'])))
+        else:
+            rejected.append(f"call site {number + 1} (line {site['line']}) {reason}")
+    return replacements, rejected
@@ -1,5 +1,9 @@
 import os
-from llm import *
+import shutil
+import tempfile
+from tree_sitter import Point
+from source_buffer import SourceBuffer
+import metrics
 
 class CodeEditor:
     def __init__(self, path):
@@ -13,6 +17,10 @@ class CodeEditor:
         start = code.find('```')
         if start != -1:
             code = code[start+3:]
+            # drop the language tag of the fence, e.g. ```python
+            first_line, _, rest = code.partition('\n')
+            if first_line.strip().isidentifier():
+                code = rest
             
         end = code.rfind('```')
         if end != -1:
@@ -24,25 +32,174 @@ class CodeEditor:
         """
         Convert a Point(row, column) to a byte offset.
         """
-        lines = code.splitlines(True)  # Keep line endings
-        byte_offset = sum(len(lines[i]) for i in range(point.row)) + point.column
-        return byte_offset
+        if not isinstance(code, SourceBuffer):
+            code = SourceBuffer(code)
+        return code.point_to_byte_offset(point)
 
     def replace_code(self, start_point, end_point, new_code):
         """
         Replace code between start_point and end_point with llm provided code in the actual code file.
+        Returns the edit in the form expected by tree-sitter's Tree.edit so the tree can be reparsed incrementally.
         """
-        with open(self.file_path, 'r') as file:
-            code = file.read()
+        with metrics.span('replace_code', file=self.file_path) as span:
+            batch = self.begin_batch()
+            start_byte = batch.source.point_to_byte_offset(start_point)
+            end_byte = batch.source.point_to_byte_offset(end_point)
+            batch.add(start_byte, end_byte, new_code)
+            edit = batch.apply()[0]
+            span.set(bytes_read=len(batch.source), bytes_written=batch.bytes_written)
+        return edit
 
-        start_byte = self.point_to_byte_offset(code, start_point)
-        end_byte = self.point_to_byte_offset(code, end_point)
-        new_code = self.remove_triple_backticks(new_code)
-        modified_code = code[:start_byte] + new_code + code[end_byte:]
+    def replace_codes(self, replacements):
+        """
+        Replace many (start_byte, end_byte, llm provided code) ranges of the actual code file in a single read and write.
+        Returns the Tree.edit edits in file order, see EditBatch.
+        """
+        batch = self.begin_batch()
+        for start_byte, end_byte, new_code in replacements:
+            batch.add(start_byte, end_byte, new_code)
+        return batch.apply()
 
-        with open(self.file_path, 'w') as file:
-            file.write(modified_code)
-            
+    def begin_batch(self):
+        """
+        Start collecting replacements of the file to apply together, see EditBatch.
+        """
+        return EditBatch(self)
 
-    
-    
\ No newline at end of file
+    def advance_point(self, point, text):
+        """
+        Get the Point(row, column) at the end of the text (bytes) inserted at the given point.
+        """
+        lines = text.count(b'\n')
+        if lines == 0:
+            return Point(point.row, point.column + len(text))
+        return Point(point.row + lines, len(text) - text.rfind(b'\n') - 1)
+
+
+class EditBatch:
+    """
+    Replacements of the code of one file, collected and then applied as a single transaction.
+    The byte ranges of the replacements refer to the file as it was read when the batch started and must not overlap.
+    Applying writes the whole new file to a temporary file which is then renamed over the original one, so a crash
+    never leaves a half written source file and a failed batch leaves the file untouched.
+    """
+    def __init__(self, editor):
+        self.editor = editor
+        self.file_path = editor.file_path
+        with open(self.file_path, 'r', encoding='utf-8') as file:
+            self.original_code = file.read()
+        self.source = SourceBuffer(self.original_code)
+        self.replacements = []
+        self.temp_path = None
+        self.committed = False
+        self.bytes_written = 0
+
+    def add(self, start_byte, end_byte, new_code):
+        """
+        Add the replacement of the code between start_byte and end_byte with llm provided code.
+        """
+        if not 0 <= start_byte <= end_byte <= len(self.source):
+            raise ValueError(f"Replacement range {start_byte}-{end_byte} is outside of {self.file_path}")
+        self.replacements.append((start_byte, end_byte, self.editor.remove_triple_backticks(new_code).encode('utf-8')))
+
+    def prepare(self):
+        """
+        Check the replacements, build the new code in a single pass and write it to a temporary file next to the file.
+        Returns the Tree.edit edits in file order, each one relative to the code after the previous ones were applied.
+        """
+        replacements = sorted(self.replacements, key=lambda replacement: replacement[0])
+        for (_, prev_end, _), (start, _, _) in zip(replacements, replacements[1:]):
+            if start < prev_end:
+                raise ValueError(f"Overlapping replacements in {self.file_path} at byte {start}")
+        data = self.source.data
+        pieces = []
+        ranges = []
+        prev_end = 0
+        new_start = 0
+        for start_byte, end_byte, new_code in replacements:
+            pieces.append(data[prev_end:start_byte])
+            new_start += start_byte - prev_end
+            pieces.append(new_code)
+            ranges.append((new_start, start_byte, end_byte, len(new_code)))
+            new_start += len(new_code)
+            prev_end = end_byte
+        pieces.append(data[prev_end:])
+        modified_code = b''.join(pieces)
+        self.bytes_written = len(modified_code)
+        self.temp_path = self.write_temp(modified_code.decode('utf-8'))
+
+        # the code before each edit is the same in the modified file, so its points can be read from there
+        modified_source = SourceBuffer(modified_code)
+        edits = []
+        for new_start, start_byte, end_byte, new_length in ranges:
+            start_point = modified_source.byte_offset_to_point(new_start)
+            edits.append(dict(start_byte=new_start, old_end_byte=new_start + end_byte - start_byte,
+                              new_end_byte=new_start + new_length, start_point=start_point,
+                              old_end_point=self.editor.advance_point(start_point, data[start_byte:end_byte]),
+                              new_end_point=modified_source.byte_offset_to_point(new_start + new_length)))
+        return edits
+
+    def write_temp(self, code):
+        """
+        Write the code to a temporary file in the directory of the file, with the same permissions.
+        """
+        fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(self.file_path)}.", suffix='.tmp',
+                                         dir=os.path.dirname(os.path.abspath(self.file_path)))
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                file.write(code)
+                file.flush()
+                os.fsync(file.fileno())
+            shutil.copymode(self.file_path, temp_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return temp_path
+
+    def commit(self):
+        """
+        Atomically replace the file with the prepared temporary file.
+        """
+        os.replace(self.temp_path, self.file_path)
+        self.temp_path = None
+        self.committed = True
+
+    def rollback(self):
+        """
+        Drop the prepared temporary file, and restore the original code if the batch was already committed.
+        """
+        if self.temp_path is not None:
+            os.remove(self.temp_path)
+            self.temp_path = None
+        if self.committed:
+            os.replace(self.write_temp(self.original_code), self.file_path)
+            self.committed = False
+
+    def apply(self):
+        """
+        Prepare and commit the batch, leaving the file untouched if anything fails.
+        Returns the Tree.edit edits to hand to CreateTree.update_tree.
+        """
+        return apply_batches([self])[self.file_path]
+
+
+def apply_batches(batches):
+    """
+    Apply the edit batches of several files as one transaction: every file is prepared before any is replaced and if
+    anything fails the files already replaced are restored.
+    Returns the Tree.edit edits of each file path.
+    """
+    edits = {}
+    with metrics.span('write_files', files=len(batches)) as span:
+        try:
+            for batch in batches:
+                edits[batch.file_path] = batch.prepare()
+            for batch in batches:
+                batch.commit()
+        except BaseException:
+            for batch in batches:
+                batch.rollback()
+            raise
+        span.set(bytes_read=sum(len(batch.source) for batch in batches),
+                 bytes_written=sum(batch.bytes_written for batch in batches))
+    return edits
@@ -0,0 +1,292 @@
+import sys
+import numpy as np
+
+# byte ranges of the definition and of the parameter list of every node, -1 when the node is not a defined function
+NODE_DTYPE = np.dtype([('start_byte', 'i8'), ('end_byte', 'i8'), ('params_start', 'i8'), ('params_end', 'i8'),
+                       ('alive', '?')])
+# one row per call site: caller and callee ids, byte ranges of the call and of its argument list (-1 if unknown)
+CALL_DTYPE = np.dtype([('caller', 'i4'), ('callee', 'i4'), ('start_byte', 'i8'), ('end_byte', 'i8'),
+                       ('args_start', 'i8'), ('args_end', 'i8')])
+RANGE_FIELDS = ('start_byte', 'end_byte', 'params_start', 'params_end', 'args_start', 'args_end')
+# calls added are buffered as tuples and packed into arrays of this many rows
+CHUNK_ROWS = 4096
+
+
+class CompactCallGraph:
+    """
+    Call graph stored in typed arrays instead of networkx dicts holding tree-sitter nodes.
+    Names are interned and mapped to integer ids, the byte ranges of every function are kept in a per-id array and every
+    call site is a row of a call array. The callers and callees of a node are found through CSR style offsets into the
+    call rows sorted by caller and by callee.
+    Removed calls are only marked dead and new calls are kept in a small unindexed tail, the rows are compacted and
+    the offsets rebuilt once the dead or new rows reach a fraction of the indexed ones, so edits stay cheap.
+    The text of parameters and arguments is only sliced from the source when asked for, see get_parameters.
+    """
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.nodes_data = np.zeros(16, dtype=NODE_DTYPE)
+        # indexed call rows, the dead ones have caller and callee -1
+        self.calls = np.zeros(0, dtype=CALL_DTYPE)
+        self.dead = 0
+        self.index = self.build_index(self.calls)
+        # calls added since the last rebuild, packed in chunks and the last tuples not packed yet
+        self.chunks = []
+        self.pending = []
+
+    def __contains__(self, name):
+        node_id = self.ids.get(name)
+        return node_id is not None and bool(self.nodes_data['alive'][node_id])
+
+    def __len__(self):
+        return int(np.count_nonzero(self.nodes_data['alive'][:len(self.names)]))
+
+    def add_node(self, name):
+        """
+        Add the node if it is not in the graph and get its id.
+        """
+        node_id = self.ids.get(name)
+        if node_id is None:
+            node_id = len(self.names)
+            name = sys.intern(name)
+            self.names.append(name)
+            self.ids[name] = node_id
+            if node_id == len(self.nodes_data):
+                self.nodes_data = np.concatenate([self.nodes_data, np.zeros(len(self.nodes_data), dtype=NODE_DTYPE)])
+            self.nodes_data[node_id] = (-1, -1, -1, -1, True)
+        elif not self.nodes_data['alive'][node_id]:
+            self.nodes_data[node_id] = (-1, -1, -1, -1, True)
+        return node_id
+
+    def nodes(self):
+        """
+        Get the names of the nodes in the graph.
+        """
+        return [self.names[node_id] for node_id in np.flatnonzero(self.nodes_data['alive'][:len(self.names)])]
+
+    def add_function(self, name, start_byte, end_byte, params_start=-1, params_end=-1):
+        """
+        Add the node of a function defined in the given byte range, or replace the range of an existing one.
+        """
+        node_id = self.add_node(name)
+        self.nodes_data[node_id] = (start_byte, end_byte, params_start, params_end, True)
+        return node_id
+
+    def clear_function(self, name):
+        """
+        Forget the definition of the function while keeping its node, e.g. for the calls to it.
+        """
+        self.nodes_data[self.ids[name]] = (-1, -1, -1, -1, True)
+
+    def is_function(self, name):
+        """
+        Check if the node is a function defined in the graph, not only called.
+        """
+        return name in self and self.nodes_data['start_byte'][self.ids[name]] >= 0
+
+    def get_function(self, name):
+        """
+        Get the (start byte, end byte) of the definition of the function, or raise a KeyError.
+        """
+        if not self.is_function(name):
+            raise KeyError(name)
+        data = self.nodes_data[self.ids[name]]
+        return int(data['start_byte']), int(data['end_byte'])
+
+    def get_functions_overlapping(self, start_byte, end_byte):
+        """
+        Get the names of the functions whose definition contains start_byte or starts in [start_byte, end_byte).
+        """
+        data = self.nodes_data[:len(self.names)]
+        defined = data['alive'] & (data['start_byte'] >= 0)
+        overlapping = defined & (((data['start_byte'] <= start_byte) & (start_byte < data['end_byte'])) |
+                                 ((start_byte <= data['start_byte']) & (data['start_byte'] < end_byte)))
+        return [self.names[node_id] for node_id in np.flatnonzero(overlapping)]
+
+    def get_parameters(self, name, source):
+        """
+        Get the text of the parameter list of the function from its SourceBuffer, or None if it is unknown.
+        """
+        data = self.nodes_data[self.ids[name]]
+        if data['params_start'] < 0:
+            return None
+        return source.text(int(data['params_start']), int(data['params_end']))
+
+    def add_call(self, caller, callee, start_byte, end_byte, args_start=-1, args_end=-1):
+        """
+        Add a call site from caller to callee, adding the nodes that are not in the graph yet.
+        """
+        self.pending.append((self.add_node(caller), self.add_node(callee), start_byte, end_byte, args_start, args_end))
+        if len(self.pending) == CHUNK_ROWS:
+            self.chunks.append(np.array(self.pending, dtype=CALL_DTYPE))
+            self.pending = []
+            if sum(len(chunk) for chunk in self.chunks) > max(len(self.calls) // 4, CHUNK_ROWS * 4):
+                self.consolidate()
+
+    def get_recent_calls(self):
+        """
+        Get the calls added since the last rebuild as a single array.
+        """
+        if self.pending or len(self.chunks) > 1:
+            self.chunks = [np.concatenate(self.chunks + [np.array(self.pending, dtype=CALL_DTYPE)])]
+            self.pending = []
+        return self.chunks[0] if self.chunks else self.calls[:0]
+
+    @staticmethod
+    def build_index(calls, count=0):
+        """
+        Get, for 'caller' and 'callee', the order of the call rows sorted by that id and the CSR offsets of every id in it.
+        """
+        index = {}
+        for field in ('caller', 'callee'):
+            ids = calls[field]
+            offsets = np.zeros(count + 1, dtype=np.int64)
+            np.cumsum(np.bincount(ids, minlength=count), out=offsets[1:])
+            index[field] = (np.argsort(ids, kind='stable'), offsets)
+        return index
+
+    def consolidate(self):
+        """
+        Drop the dead call rows, append the recent ones and rebuild the offsets.
+        """
+        calls = self.calls[self.calls['caller'] >= 0] if self.dead else self.calls
+        self.calls = np.concatenate([calls, self.get_recent_calls()])
+        self.chunks = []
+        self.dead = 0
+        self.index = self.build_index(self.calls, len(self.names))
+
+    def get_indexed_positions(self, node_id, field):
+        """
+        Get the positions of the indexed call rows whose field ('caller' or 'callee') is the node, dead ones included.
+        """
+        order, offsets = self.index[field]
+        if node_id + 1 >= len(offsets):
+            return order[:0]
+        return order[offsets[node_id]:offsets[node_id + 1]]
+
+    def get_call_rows(self, name, field):
+        """
+        Get the live call rows whose field ('caller' or 'callee') is the given node, in the order they were added.
+        """
+        node_id = self.ids.get(name)
+        if node_id is None:
+            return self.calls[:0]
+        # the sort is stable so the positions of a node are in the order the rows were added
+        rows = self.calls[self.get_indexed_positions(node_id, field)]
+        recent = self.get_recent_calls()
+        return np.concatenate([rows[rows['caller'] >= 0], recent[recent[field] == node_id]])
+
+    def remove_rows(self, node_ids, fields):
+        """
+        Remove the calls whose caller or callee (as given by fields) is one of the nodes.
+        """
+        if not node_ids:
+            return
+        for node_id in node_ids:
+            for field in fields:
+                positions = self.get_indexed_positions(node_id, field)
+                positions = positions[self.calls['caller'][positions] >= 0]
+                self.calls['caller'][positions] = -1
+                self.calls['callee'][positions] = -1
+                self.dead += len(positions)
+        recent = self.get_recent_calls()
+        if len(recent):
+            keep = np.ones(len(recent), dtype=bool)
+            for field in fields:
+                keep &= ~np.isin(recent[field], node_ids)
+            self.chunks = [recent[keep]]
+        if self.dead > len(self.calls) // 4:
+            self.consolidate()
+
+    def remove_calls_from(self, names):
+        """
+        Remove every call made by the given nodes.
+        """
+        self.remove_rows([self.ids[name] for name in names if name in self.ids], ('caller',))
+
+    def remove_node(self, name):
+        """
+        Remove the node and every call made by or to it. Its id is kept for the name in case it is added again.
+        """
+        node_id = self.ids[name]
+        self.remove_rows([node_id], ('caller', 'callee'))
+        self.nodes_data['alive'][node_id] = False
+
+    def shift(self, start_byte, old_end_byte, new_end_byte):
+        """
+        Shift every byte range after an edit replacing [start_byte, old_end_byte) with [start_byte, new_end_byte).
+        The ranges overlapping the edit must have been removed.
+        """
+        delta = new_end_byte - old_end_byte
+        for array in (self.nodes_data, self.calls, self.get_recent_calls()):
+            for field in RANGE_FIELDS:
+                if field in array.dtype.names:
+                    column = array[field]
+                    column[column >= old_end_byte] += delta
+
+    def successors(self, name):
+        """
+        Get the names of the nodes called by the node, in the order of the calls.
+        """
+        return [self.names[node_id] for node_id in dict.fromkeys(self.get_call_rows(name, 'caller')['callee'].tolist())]
+
+    def predecessors(self, name):
+        """
+        Get the names of the nodes calling the node, in the order of the calls.
+        """
+        return [self.names[node_id] for node_id in dict.fromkeys(self.get_call_rows(name, 'callee')['caller'].tolist())]
+
+    def in_degree(self, name):
+        """
+        Get the number of nodes calling the node.
+        """
+        return len(self.predecessors(name))
+
+    def degree(self, name):
+        """
+        Get the number of nodes calling or called by the node.
+        """
+        return len(self.predecessors(name)) + len(self.successors(name))
+
+    def get_calls(self, caller, callee):
+        """
+        Get the (start byte, end byte, arguments start byte, arguments end byte) of the calls from caller to callee.
+        """
+        rows = self.get_call_rows(caller, 'caller')
+        rows = rows[rows['callee'] == self.ids[callee]] if callee in self.ids else rows[:0]
+        return [tuple(row) for row in rows[['start_byte', 'end_byte', 'args_start', 'args_end']].tolist()]
+
+    def edges(self):
+        """
+        Get the distinct (caller, callee) pairs of the calls.
+        """
+        calls = np.concatenate([self.calls[self.calls['caller'] >= 0], self.get_recent_calls()])
+        pairs = dict.fromkeys(zip(calls['caller'].tolist(), calls['callee'].tolist()))
+        return [(self.names[caller], self.names[callee]) for caller, callee in pairs]
+
+    def nbytes(self):
+        """
+        Get the size in bytes of the node and call arrays.
+        """
+        return self.nodes_data.nbytes + self.calls.nbytes + self.get_recent_calls().nbytes
+
+    def to_networkx(self, source=None):
+        """
+        Convert the graph to a networkx DiGraph, for visualization only.
+        If the SourceBuffer of the file is given, the nodes get their parameter list as 'params' and the edges the
+        argument lists of their calls as 'args'.
+        """
+        # networkx is only loaded when a graph is drawn
+        import networkx as nx
+        graph = nx.DiGraph()
+        for name in self.nodes():
+            params = self.get_parameters(name, source) if source is not None else None
+            graph.add_node(name, **({'params': params} if params is not None else {}))
+        for caller, callee in self.edges():
+            if source is None:
+                graph.add_edge(caller, callee)
+            else:
+                graph.add_edge(caller, callee, args=[source.text(args_start, args_end)
+                                                     for _, _, args_start, args_end in self.get_calls(caller, callee)
+                                                     if args_start >= 0])
+        return graph
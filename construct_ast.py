@@ -2,12 +2,15 @@ import os
 import tree_sitter
 import tree_sitter_python as tspython
 from tree_sitter import Language, Parser
-import ast
-import networkx as nx
-import matplotlib.pyplot as plt
-import plotly.graph_objects as go
+from source_buffer import SourceBuffer
+from compact_graph import CompactCallGraph
+import metrics
 
 PY_LANGUAGE = Language(tspython.language())
+# queries are compiled once per process
+FUNCTIONS_QUERY = PY_LANGUAGE.query("(function_definition) @function")
+IMPORTS_QUERY = PY_LANGUAGE.query("[(import_statement) (import_from_statement)] @import")
+SCOPE_TYPES = ('function_definition', 'class_definition')
 
 # Load Tree-sitter Python language module
 # tree_sitter_python = tree_sitter.Language('build/tree-sitter-python.so', 'python')
@@ -15,99 +18,212 @@ PY_LANGUAGE = Language(tspython.language())
 class CreateTree:
     def __init__(self, code, file_path):
         self.parser = Parser(PY_LANGUAGE)
-        self.tree_nx = nx.DiGraph()
+        self.graph = CompactCallGraph()
         self.code = code
+        self.source = SourceBuffer(code)
         self.file_path = file_path 
+        self.tree = None
     
     def parse_ast(self):
         """
         Parse the code using the Tree-sitter parser.
         """
-        tree = self.parser.parse(bytes(self.code, "utf-8"))
+        tree = self.parser.parse(self.source.data)
         return tree
     
     def point_to_byte_offset(self, point):
         """
         Convert a Point(row, column) to a byte offset.
         """
-        lines = self.code.splitlines(True)
-        byte_offset = sum(len(lines[i]) for i in range(point.row)) + point.column
-        return byte_offset
+        return self.source.point_to_byte_offset(point)
 
     def get_node_text(self, start_point, end_point):
         """
         Extract code between start_point and end_point.
         """
-        start_byte = self.point_to_byte_offset(start_point)
-        end_byte = self.point_to_byte_offset(end_point)
-        ans = self.code[start_byte:end_byte]
-        return str(ans)
+        return self.source.text_between_points(start_point, end_point)
 
-    def add_node_with_attribute(self, func_node):
+    def add_node_with_attribute(self, func_node, name):
         """ 
-        Add a node to the graph with the function name and parameters as attributes.
+        Add a node to the graph with the byte ranges of the function and of its parameters.
         """
-        name = func_node.child_by_field_name('name').text.decode('utf-8')
         params_node = func_node.child_by_field_name('parameters')
-        params_list = [param.text.decode('utf-8') for param in params_node.children if param.text.decode('utf-8') not in ('(', ')', ',')]
-        self.tree_nx.add_node(name, params=params_list, func_node=func_node)
-        # G.nodes[name]['params'] = params
+        self.graph.add_function(name, func_node.start_byte, func_node.end_byte, params_node.start_byte, params_node.end_byte)
 
-    def add_edge_with_attribute(self, caller, callee):
+    def add_edge_with_attribute(self, name, callee):
         """ 
-        Add an edge to the graph with the callee function name and its arguments as attributes.
+        Add an edge to the graph with the byte ranges of the call and of its arguments.
         """
-        name = caller.child_by_field_name('name').text.decode('utf-8')
         target = callee.child_by_field_name('function').text.decode('utf-8')
-        # G.add_edge(name, target)
         args_node = callee.child_by_field_name('arguments')
-        args_list = [i.text.decode('utf-8') for i in args_node.children if i.text.decode('utf-8') not in ('(', ')', ',')]
-        self.tree_nx.add_edge(name, target, args=args_list, node=callee)
+        self.graph.add_call(name, target, callee.start_byte, callee.end_byte, args_node.start_byte, args_node.end_byte)
+
+    def add_function_entry(self, entry):
+        """ 
+        Add the function and the calls made directly in its body to the graph, see get_function_entries.
+        """
+        self.add_node_with_attribute(entry['node'], entry['scope_name'])
+        for callee in entry['calls']:
+            self.add_edge_with_attribute(entry['scope_name'], callee)
+
+    def get_function_entries(self, node):
+        """ 
+        Walk the subtree of the node once with a tree cursor and get an entry for every function definition in it:
+        its node, name, scope name qualified with the enclosing classes and functions (e.g. 'Logger.log'), the scope
+        names of the enclosing functions from the innermost outwards, the scope name of the nearest enclosing class and
+        the call nodes whose innermost enclosing function it is.
+        """
+        # definitions enclosing the current node as (type, scope name, entry), entry is None for classes and for the
+        # functions enclosing the walked subtree
+        scopes = []
+        ancestor = node.parent
+        while ancestor is not None:
+            if ancestor.type in SCOPE_TYPES:
+                scopes.insert(0, [ancestor.type, ancestor.child_by_field_name('name').text.decode('utf-8'), None])
+            ancestor = ancestor.parent
+        for i in range(1, len(scopes)):
+            scopes[i][1] = f"{scopes[i - 1][1]}.{scopes[i][1]}"
+        entries = []
+        cursor = node.walk()
+        while True:
+            current = cursor.node
+            if current.type in SCOPE_TYPES:
+                name = current.child_by_field_name('name').text.decode('utf-8')
+                scope_name = f"{scopes[-1][1]}.{name}" if scopes else name
+                entry = None
+                if current.type == 'function_definition':
+                    classes = [scope[1] for scope in scopes if scope[0] == 'class_definition']
+                    entry = {
+                        'node': current,
+                        'name': name,
+                        'scope_name': scope_name,
+                        'class_name': classes[-1] if classes else None,
+                        'scopes': [scope_name] + [scope[1] for scope in reversed(scopes) if scope[0] == 'function_definition'],
+                        'calls': [],
+                    }
+                    entries.append(entry)
+                scopes.append([current.type, scope_name, entry])
+            elif current.type == 'call':
+                # the call belongs to the innermost enclosing function, class bodies run in the function around them
+                function = next((scope[2] for scope in reversed(scopes) if scope[0] == 'function_definition'), None)
+                if function is not None:
+                    function['calls'].append(current)
+            if cursor.goto_first_child():
+                continue
+            # leave the node and its ancestors until one has a next sibling
+            while True:
+                if cursor.node.type in SCOPE_TYPES:
+                    scopes.pop()
+                if cursor.goto_next_sibling():
+                    break
+                if not cursor.goto_parent():
+                    return entries
         
 
     def call_graph(self):
         """ 
         Construct a call graph of functions only from the code.
         """
-        tree = self.parser.parse(bytes(self.code, "utf-8"))
-        root = tree.root_node
-        functions_query = PY_LANGUAGE.query("(function_definition) @function") 
-        calls_query = PY_LANGUAGE.query("(call) @call")
-        functions = functions_query.captures(root) 
-        # G = nx.DiGraph()
-        # print(functions)
-        list_functions = []
-        for func, _ in functions:
-            list_functions.append(func.child_by_field_name('name').text.decode('utf-8'))
-            calls = calls_query.captures(func) 
-            self.add_node_with_attribute(func)
-            for callee, _ in calls:
-                # print(callee)
-                self.add_edge_with_attribute(func, callee)
-        return self.tree_nx, list_functions
+        with metrics.span('call_graph', file=self.file_path, bytes_read=len(self.source)) as span:
+            tree = self.parse_ast()
+            self.tree = tree
+            list_functions = []
+            calls = 0
+            for entry in self.get_function_entries(tree.root_node):
+                list_functions.append(entry['scope_name'])
+                calls += len(entry['calls'])
+                self.add_function_entry(entry)
+            self.graph.consolidate()
+            span.set(functions=len(list_functions), calls=calls)
+        return self.graph, list_functions
     
+    def resolve_function_name(self, name):
+        """ 
+        Get the scope name of the function, which may be given by its scope name or, if it is unique, its bare name.
+        """
+        if self.graph.is_function(name):
+            return name
+        matches = [node for node in self.graph.nodes() if node.endswith(f".{name}") and self.graph.is_function(node)]
+        return matches[0] if len(matches) == 1 else name
+
     def get_function_from_name(self, name):
         """ 
-        Get the function code from the function name.
+        Get the function code from the function name (scope name like 'Logger.log', or a unique bare name).
         """
         try:
-            st = self.tree_nx.nodes[name]['func_node'].start_point
-            en = self.tree_nx.nodes[name]['func_node'].end_point
-            func = self.get_node_text(st, en)
-            return func
+            start_byte, end_byte = self.graph.get_function(self.resolve_function_name(name))
+            return self.source.text(start_byte, end_byte)
         except KeyError as e:
             print(f"Error: The function name '{name}' does not exist in the tree. Please check the function name and try again.")
             print(f"KeyError: {e}")
             return None
     
+    def get_function_nodes(self):
+        """ 
+        Get the function definition nodes of the current parse tree.
+        """
+        if self.tree is None:
+            self.tree = self.parse_ast()
+        return [func for func, _ in FUNCTIONS_QUERY.captures(self.tree.root_node)]
+
+    def get_imports(self):
+        """
+        Get the names bound by the import statements of the file as (local name, module, imported name) tuples.
+        The module keeps its leading dots for relative imports and the imported name is None for plain 'import' statements.
+        """
+        if self.tree is None:
+            self.tree = self.parse_ast()
+        imports = []
+        for statement, _ in IMPORTS_QUERY.captures(self.tree.root_node):
+            module_node = statement.child_by_field_name('module_name')
+            module = module_node.text.decode('utf-8') if module_node is not None else None
+            for name_node in statement.children_by_field_name('name'):
+                alias_node = None
+                if name_node.type == 'aliased_import':
+                    alias_node = name_node.child_by_field_name('alias')
+                    name_node = name_node.child_by_field_name('name')
+                name = name_node.text.decode('utf-8')
+                if module is None:
+                    # 'import a.b' binds 'a' while 'import a.b as x' binds 'x' to 'a.b'
+                    if alias_node is None:
+                        imports.append((name.split('.')[0], name.split('.')[0], None))
+                    else:
+                        imports.append((alias_node.text.decode('utf-8'), name, None))
+                else:
+                    local_name = alias_node.text.decode('utf-8') if alias_node is not None else name
+                    imports.append((local_name, module, name))
+        return imports
+
+    def get_file_record(self):
+        """
+        Get a compact, picklable summary of the file: its imports and, for every function, its scope names, byte range
+        and the (callee text, start byte, end byte) of the calls made directly in its body, the calls of nested functions
+        belong to them. Used to build the SymbolIndex and ProjectCallGraph.
+        """
+        if self.tree is None:
+            self.tree = self.parse_ast()
+        functions = []
+        for entry in self.get_function_entries(self.tree.root_node):
+            calls = [(call_node.child_by_field_name('function').text.decode('utf-8'), call_node.start_byte, call_node.end_byte)
+                     for call_node in entry['calls']]
+            functions.append({
+                'name': entry['name'],
+                'scope_name': entry['scope_name'],
+                'class_name': entry['class_name'],
+                'scopes': entry['scopes'],
+                'start_byte': entry['node'].start_byte,
+                'end_byte': entry['node'].end_byte,
+                'calls': calls,
+            })
+        return {'file_path': self.file_path, 'functions': functions, 'imports': self.get_imports()}
+
     def get_st_and_end_points(self, name):
         """ 
-        Get the start and end points of the function from the function name.
+        Get the start and end points of the function from the function name (scope name or unique bare name).
         """
         try:
-            st = self.tree_nx.nodes[name]['func_node'].start_point
-            en = self.tree_nx.nodes[name]['func_node'].end_point
-            return (st,en)
+            start_byte, end_byte = self.graph.get_function(self.resolve_function_name(name))
+            return (self.source.byte_offset_to_point(start_byte), self.source.byte_offset_to_point(end_byte))
         except KeyError as e:
             print(f"Error: The function name '{name}' does not exist in the tree. Please check the function name and try again.")
             print(f"KeyError: {e}")
@@ -117,10 +233,10 @@ class CreateTree:
         """ 
         Get the list of functions that call the given function.
         """
-        if function_name not in self.tree_nx:
+        if function_name not in self.graph:
             print(f"Function {function_name} does not exist in the call graph.")
             return []
-        callers = list(self.tree_nx.predecessors(function_name))
+        callers = self.graph.predecessors(function_name)
         return callers
     
     def get_callers_function_code(self, function_name):
@@ -134,113 +250,167 @@ class CreateTree:
         return code_list
     
         
-    def update_tree(self, code):
+    def update_tree(self, code, edit=None):
         """ 
         Update the tree with the new code.
+        If the edit made by CodeEditor.replace_code (or the list of edits made by CodeEditor.replace_codes) is given, the
+        old tree is edited and reparsed incrementally and only the functions overlapping the edited ranges are rebuilt,
+        the byte ranges of the rest are shifted in place.
         """
         self.code = code
-        self.tree_nx , list_ = self.call_graph()
-        # return self.tree_nx , list_
+        self.source = SourceBuffer(code)
+        if edit is None or self.tree is None:
+            self.graph = CompactCallGraph()
+            self.graph, list_ = self.call_graph()
+            return
+        edits = edit if isinstance(edit, list) else [edit]
+        for edit in edits:
+            self.tree.edit(**edit)
+            self.remove_edited_functions(edit)
+        self.tree = self.parser.parse(self.source.data, self.tree)
+        functions = {}
+        for edit in edits:
+            for func, _ in FUNCTIONS_QUERY.captures(self.tree.root_node, start_byte=edit['start_byte'],
+                                                    end_byte=max(edit['new_end_byte'], edit['start_byte'] + 1)):
+                functions[(func.start_byte, func.end_byte)] = func
+        captured = {func.id for func in functions.values()}
+        for func in functions.values():
+            # nested functions are walked with the outermost captured function around them
+            parent = func.parent
+            while parent is not None and parent.id not in captured:
+                parent = parent.parent
+            if parent is not None:
+                continue
+            for entry in self.get_function_entries(func):
+                # the range also captures untouched neighbours, whose calls were kept and shifted
+                node = entry['node']
+                if self.graph.is_function(entry['scope_name']) and \
+                        self.graph.get_function(entry['scope_name']) == (node.start_byte, node.end_byte):
+                    continue
+                self.add_function_entry(entry)
+        self.graph.consolidate()
+
+    def remove_edited_functions(self, edit):
+        """ 
+        Remove the functions overlapping the edited range from the graph and shift the byte ranges of the rest.
+        """
+        for name in self.graph.get_functions_overlapping(edit['start_byte'], edit['old_end_byte']):
+            callees = self.graph.successors(name)
+            self.graph.remove_calls_from([name])
+            for callee in callees:
+                if callee != name and not self.graph.is_function(callee) and self.graph.degree(callee) == 0:
+                    self.graph.remove_node(callee)
+            if self.graph.in_degree(name) == 0:
+                self.graph.remove_node(name)
+            else:
+                self.graph.clear_function(name)
+        self.graph.shift(edit['start_byte'], edit['old_end_byte'], edit['new_end_byte'])
             
 
     def draw_graph(self):
         """ 
         Draw the call graph using NetworkX and Plotly.
         """
-        node_labels = {}
-        for n in self.tree_nx.nodes():
-            if 'params' in self.tree_nx.nodes[n]:
-                node_labels[n] = f"{n}\n{self.tree_nx.nodes[n]['params']}"
-            else:
-                node_labels[n] = str(n)  # Fallback label if 'params' is missing or empty
-
-        edge_labels = {e: f"{self.tree_nx.edges[e]['args']}" for e in self.tree_nx.edges()}
-        # Kamada-Kawai layout
-        pos = nx.kamada_kawai_layout(self.tree_nx)
-
-        # Create plotly scatter plot for nodes
-        node_x = []
-        node_y = []
-        for node in self.tree_nx.nodes():
-            x, y = pos[node]
-            node_x.append(x)
-            node_y.append(y)
-
-        node_trace = go.Scatter(
-            x=node_x, y=node_y,
-            mode='markers+text',
-            text=[node_labels[n] for n in self.tree_nx.nodes()],
-            textposition='top center',
-            marker=dict(size=20, color='skyblue', line=dict(width=2)),
-            hoverinfo='text'
-        )
-
-        # Create plotly scatter plot for edges
-        edge_x = []
-        edge_y = []
-        annotations = []
-        for edge in self.tree_nx.edges():
-            x0, y0 = pos[edge[0]]
-            x1, y1 = pos[edge[1]]
-            edge_x.append(x0)
-            edge_x.append(x1)
-            edge_x.append(None)
-            edge_y.append(y0)
-            edge_y.append(y1)
-            edge_y.append(None)
-
-            # Calculate the position and direction for the arrowhead
-            arrow_x = x1
-            arrow_y = y1
-            arrow_dx = x1 - x0
-            arrow_dy = y1 - y0
-
-            annotations.append(
-                dict(
-                    x=arrow_x,
-                    y=arrow_y,
-                    ax=x0,
-                    ay=y0,
-                    xref='x',
-                    yref='y',
-                    axref='x',
-                    ayref='y',
-                    showarrow=True,
-                    arrowhead=3,
-                    arrowsize=2,
-                    arrowwidth=1,
-                    arrowcolor='black'
+        with metrics.span('draw_graph', file=self.file_path) as span:
+            # plotly is only loaded when a graph is drawn
+            import plotly.graph_objects as go
+            graph = self.graph.to_networkx(self.source)
+            span.set(nodes=graph.number_of_nodes(), edges=graph.number_of_edges())
+            node_labels = {}
+            for n in graph.nodes():
+                if 'params' in graph.nodes[n]:
+                    node_labels[n] = f"{n}\n{graph.nodes[n]['params']}"
+                else:
+                    node_labels[n] = str(n)  # Fallback label if 'params' is missing or empty
+
+            edge_labels = {e: f"{graph.edges[e]['args']}" for e in graph.edges()}
+            # force directed layout for small graphs, linear time grouped layout for large ones
+            from graph_render import layout_graph
+            pos = layout_graph(graph)
+
+            # Create plotly scatter plot for nodes
+            node_x = []
+            node_y = []
+            for node in graph.nodes():
+                x, y = pos[node]
+                node_x.append(x)
+                node_y.append(y)
+
+            node_trace = go.Scatter(
+                x=node_x, y=node_y,
+                mode='markers+text',
+                text=[node_labels[n] for n in graph.nodes()],
+                textposition='top center',
+                marker=dict(size=20, color='skyblue', line=dict(width=2)),
+                hoverinfo='text'
+            )
+
+            # Create plotly scatter plot for edges
+            edge_x = []
+            edge_y = []
+            annotations = []
+            for edge in graph.edges():
+                x0, y0 = pos[edge[0]]
+                x1, y1 = pos[edge[1]]
+                edge_x.append(x0)
+                edge_x.append(x1)
+                edge_x.append(None)
+                edge_y.append(y0)
+                edge_y.append(y1)
+                edge_y.append(None)
+
+                # Calculate the position and direction for the arrowhead
+                arrow_x = x1
+                arrow_y = y1
+                arrow_dx = x1 - x0
+                arrow_dy = y1 - y0
+
+                annotations.append(
+                    dict(
+                        x=arrow_x,
+                        y=arrow_y,
+                        ax=x0,
+                        ay=y0,
+                        xref='x',
+                        yref='y',
+                        axref='x',
+                        ayref='y',
+                        showarrow=True,
+                        arrowhead=3,
+                        arrowsize=2,
+                        arrowwidth=1,
+                        arrowcolor='black'
+                    )
                 )
+
+            edge_trace = go.Scatter(
+                x=edge_x, y=edge_y,
+                line=dict(width=2, color='black'),
+                hoverinfo='none',
+                mode='lines'
+            )
+
+            # Create plotly scatter plot for edge labels
+            edge_label_trace = go.Scatter(
+                x=[(pos[edge[0]][0] + pos[edge[1]][0]) / 2 for edge in graph.edges()],
+                y=[(pos[edge[0]][1] + pos[edge[1]][1]) / 2 for edge in graph.edges()],
+                mode='text',
+                text=[edge_labels[edge] for edge in graph.edges()],
+                textposition='top center',
+                textfont=dict(color='red', size=12)
             )
 
-        edge_trace = go.Scatter(
-            x=edge_x, y=edge_y,
-            line=dict(width=2, color='black'),
-            hoverinfo='none',
-            mode='lines'
-        )
-
-        # Create plotly scatter plot for edge labels
-        edge_label_trace = go.Scatter(
-            x=[(pos[edge[0]][0] + pos[edge[1]][0]) / 2 for edge in self.tree_nx.edges()],
-            y=[(pos[edge[0]][1] + pos[edge[1]][1]) / 2 for edge in self.tree_nx.edges()],
-            mode='text',
-            text=[edge_labels[edge] for edge in self.tree_nx.edges()],
-            textposition='top center',
-            textfont=dict(color='red', size=12)
-        )
-
-        # Create figure with title and annotations
-        fig = go.Figure(data=[edge_trace, node_trace, edge_label_trace],
-                        layout=go.Layout(
-                            title=self.file_path,  # Add your title here
-                            showlegend=False,
-                            hovermode='closest',
-                            margin=dict(b=20, l=5, r=5, t=40),
-                            xaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
-                            yaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
-                            height=800,  # Adjust height as needed
-                            annotations=annotations
-                        ))
-
-        fig.show()
\ No newline at end of file
+            # Create figure with title and annotations
+            fig = go.Figure(data=[edge_trace, node_trace, edge_label_trace],
+                            layout=go.Layout(
+                                title=self.file_path,  # Add your title here
+                                showlegend=False,
+                                hovermode='closest',
+                                margin=dict(b=20, l=5, r=5, t=40),
+                                xaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
+                                yaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
+                                height=800,  # Adjust height as needed
+                                annotations=annotations
+                            ))
+
+            fig.show()
\ No newline at end of file
@@ -0,0 +1,545 @@
+import os
+import sys
+import json
+import time
+import pickle
+import select
+import socket
+import struct
+import stat
+import hashlib
+import argparse
+import tempfile
+import threading
+import socketserver
+from repo_scan import scan_repository, parse_files
+from parse_cache import ParseCache, content_hash
+from construct_ast import CreateTree
+from source_buffer import SourceBuffer
+from symbol_index import SymbolIndex
+from project_graph import ProjectCallGraph
+import metrics
+
+# inotify event bits, see inotify(7)
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+# time to let a burst of writes settle before the changed files are parsed
+DEBOUNCE = 0.05
+# more changed files than this are parsed in the worker processes
+PARALLEL_FILES = 32
+MESSAGE_HEADER = struct.Struct('>cQ')
+# pid, uid and gid of the peer of a Unix socket, see SO_PEERCRED in socket(7)
+PEER_CREDENTIALS = struct.Struct('3i')
+
+
+def get_socket_directory():
+    """
+    Get the directory of the sockets of the current user, in XDG_RUNTIME_DIR or else in the temporary directory, made
+    so only the user can enter it. Raises a PermissionError if it exists but others can access it or own it.
+    """
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        directory = os.path.join(runtime_dir, 'function_updater')
+    else:
+        directory = os.path.join(tempfile.gettempdir(), f"function_updater-{os.getuid()}")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{directory} must be a directory owned and only accessible by the current user")
+    return directory
+
+
+def get_socket_path(directory):
+    """
+    Get the default socket of the daemon of a repository, derived from its absolute path, in the private directory
+    of the user so no one else can put a socket there.
+    """
+    digest = hashlib.sha1(os.path.realpath(directory).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(get_socket_directory(), f"{digest}.sock")
+
+
+def check_peer(connection, socket_path):
+    """
+    Raise a PermissionError unless the socket and the process answering on it belong to the current user, as the
+    snapshots it sends are unpickled.
+    """
+    if os.stat(socket_path).st_uid != os.getuid():
+        raise PermissionError(f"{socket_path} belongs to another user")
+    if hasattr(socket, 'SO_PEERCRED'):
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEER_CREDENTIALS.size)
+        if PEER_CREDENTIALS.unpack(credentials)[1] != os.getuid():
+            raise PermissionError(f"The process listening on {socket_path} belongs to another user")
+
+
+class InotifyWatcher:
+    """
+    Watch the directories of a repository with Linux inotify, called through ctypes so no package is needed.
+    Raises OSError (or AttributeError off Linux) if inotify is not available.
+    """
+    def __init__(self, directories):
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.directories = {}
+        for directory in directories:
+            if not self.add_directory(directory):
+                self.close()
+                raise OSError(ctypes.get_errno(), f"Cannot watch {directory}")
+
+    def add_directory(self, directory):
+        """
+        Watch a directory, returns False if it cannot be watched, e.g. past the inotify watch limit.
+        """
+        if directory in self.directories:
+            return True
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            return False
+        self.watches[wd] = directory
+        self.directories[directory] = wd
+        return True
+
+    def update_directories(self, directories):
+        """
+        Watch the new directories of the repository, the removed ones drop out by themselves.
+        """
+        for directory in directories:
+            if not self.add_directory(directory):
+                print(f"Cannot watch {directory}: {os.strerror(self.ctypes.get_errno())}")
+
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds for changes and get the changed python files and whether files or directories were
+        added or removed, which needs a rescan of the repository.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set(), False
+        time.sleep(DEBOUNCE)
+        changed = set()
+        rescan = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    rescan = True
+                elif mask & IN_IGNORED:
+                    self.directories.pop(self.watches.pop(wd, None), None)
+                elif wd in self.watches:
+                    if mask & IN_ISDIR or name == '.gitignore':
+                        rescan = True
+                    elif name.endswith('.py'):
+                        changed.add(os.path.join(self.watches[wd], name))
+                        rescan = rescan or bool(mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO))
+        return changed, rescan
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Watch a repository by scanning it and comparing the modification time and size of its python files every interval
+    seconds, where inotify is not available.
+    """
+    def __init__(self, root, filepaths, interval=1.0):
+        self.root = root
+        self.interval = interval
+        self.stats = self.stat_files(filepaths)
+
+    @staticmethod
+    def stat_files(filepaths):
+        """
+        Get the (modification time, size) of the files that still exist.
+        """
+        stats = {}
+        for filepath in filepaths:
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            stats[filepath] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    def update_directories(self, directories):
+        pass
+
+    def poll(self, timeout):
+        """
+        Wait for the next scan, at most timeout seconds, and get the changed python files and whether files were
+        added or removed.
+        """
+        time.sleep(min(timeout, self.interval))
+        stats = self.stat_files(scan_repository(self.root)[1])
+        changed = {filepath for filepath in stats.keys() | self.stats.keys() if stats.get(filepath) != self.stats.get(filepath)}
+        rescan = stats.keys() != self.stats.keys()
+        self.stats = stats
+        return changed, rescan
+
+    def close(self):
+        pass
+
+
+def make_watcher(root, directories, filepaths, poll_interval=None):
+    """
+    Get an inotify watcher of the repository, or a polling one if poll_interval is given or inotify is not available.
+    """
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError) as e:
+            print(f"inotify is not available ({e}), polling the files every second")
+            poll_interval = 1.0
+    return PollingWatcher(root, filepaths, poll_interval)
+
+
+class RepositoryDaemon:
+    """
+    Symbol index and project call graph of a repository kept in memory and updated as its files change, so the
+    frontends and other tools can query them or load them without parsing the repository again.
+    The changed files are parsed again and, if their functions were added or removed, the calls of the files importing
+    their module are resolved again. The state is guarded by a lock as the queries are answered from other threads.
+    """
+    def __init__(self, directory, workers=None, cache=None):
+        self.root = os.path.abspath(directory)
+        self.workers = workers
+        self.cache = cache
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        # source of the files by path, read when first queried and dropped when the file changes
+        self.sources = {}
+        self.hashes = {}
+        start = time.perf_counter()
+        self.directories, self.filepaths = scan_repository(self.root)
+        records = parse_files(self.filepaths, workers, cache)
+        self.records = {record['file_path']: record for record in records}
+        self.symbol_index = SymbolIndex(self.root)
+        for record in records:
+            self.symbol_index.update_file(record)
+        self.project_graph = ProjectCallGraph(self.symbol_index)
+        self.project_graph.update_files(records)
+        print(f"Loaded {len(self.filepaths)} files and {len(self.symbol_index.symbols)} functions "
+              f"in {time.perf_counter() - start:.2f}s")
+
+    def imports_module(self, record, modules):
+        """
+        Check if the file of the record imports one of the modules, one of their packages or something from them.
+        """
+        for target in self.project_graph.get_aliases(record['imports'], record['file_path']).values():
+            for module in modules:
+                if target == module or target.startswith(module + '.') or module.startswith(target + '.'):
+                    return True
+        return False
+
+    def parse_changed(self, filepaths):
+        """
+        Get the records of the files whose content changed since they were last parsed, with their new sources.
+        """
+        if len(filepaths) > PARALLEL_FILES:
+            for filepath in filepaths:
+                self.hashes.pop(filepath, None)
+            return parse_files(filepaths, self.workers, self.cache), {}
+        records = []
+        sources = {}
+        for filepath in filepaths:
+            # hashed like parse_files hashes the files, then decoded with the newlines of text mode like the rest of
+            # the pipeline reads them, so the byte offsets match the frontends
+            with open(filepath, 'rb') as file:
+                data = file.read()
+            file_hash = content_hash(data)
+            if self.hashes.get(filepath) == file_hash:
+                continue
+            self.hashes[filepath] = file_hash
+            tree = CreateTree(data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n'), filepath)
+            records.append(tree.get_file_record())
+            sources[filepath] = tree.source
+        return records, sources
+
+    def apply_changes(self, changed, rescan=False):
+        """
+        Update the indexes after the given python files changed. With rescan the repository is scanned again for added
+        and removed files.
+        """
+        with metrics.span('daemon_update') as span:
+            filepaths = self.filepaths
+            if rescan:
+                self.directories, filepaths = scan_repository(self.root)
+                changed = set(changed) | (set(filepaths) ^ set(self.filepaths))
+            current = set(filepaths)
+            updated = sorted(path for path in changed if path in current and os.path.isfile(path))
+            removed = sorted(path for path in changed if path not in updated and path in self.records)
+            records, sources = self.parse_changed(updated)
+            with self.lock:
+                self.filepaths = filepaths
+                modules = set()
+                for path in removed:
+                    self.symbol_index.remove_file(path)
+                    self.project_graph.remove_file(path)
+                    self.records.pop(path)
+                    self.sources.pop(path, None)
+                    self.hashes.pop(path, None)
+                    modules.add(self.symbol_index.module_name(path))
+                for record in records:
+                    path = record['file_path']
+                    names = set(self.symbol_index.by_file.get(path, []))
+                    self.symbol_index.update_file(record)
+                    if set(self.symbol_index.by_file[path]) != names:
+                        modules.add(self.symbol_index.module_name(path))
+                for record in records:
+                    self.records[record['file_path']] = record
+                    self.sources.pop(record['file_path'], None)
+                self.sources.update(sources)
+                # the calls into functions that were added or removed are resolved again in the files importing them
+                parsed = {record['file_path'] for record in records}
+                importing = [record for path, record in self.records.items()
+                             if path not in parsed and modules and self.imports_module(record, modules)]
+                self.project_graph.update_files(records + importing)
+            span.set(files=len(records) + len(removed))
+        if records or removed:
+            print(f"Updated {len(records)} files, removed {len(removed)}")
+
+    def get_source(self, file_path):
+        """
+        Get the SourceBuffer of a file, read on first use.
+        """
+        if file_path not in self.sources:
+            with open(file_path, 'r', encoding='utf-8') as file:
+                self.sources[file_path] = SourceBuffer(file.read())
+        return self.sources[file_path]
+
+    def get_symbol(self, name):
+        """
+        Get the symbol of a qualified name or unique bare name, or raise a KeyError naming the candidates.
+        """
+        symbols = self.symbol_index.lookup(name)
+        if len(symbols) != 1:
+            raise KeyError(f"'{name}' matches {[symbol['qualified_name'] for symbol in symbols] or 'no function'}")
+        return symbols[0]
+
+    def handle(self, request):
+        """
+        Answer a query: 'ping', 'lookup', 'source', 'callers', 'points' or 'snapshot' (pickled for load_snapshot),
+        the ones about a function take its 'name'. 'shutdown' stops the daemon.
+        """
+        op = request.get('op')
+        with self.lock:
+            if op == 'ping':
+                return {'root': self.root, 'pid': os.getpid(), 'files': len(self.filepaths),
+                        'functions': len(self.symbol_index.symbols)}
+            if op == 'lookup':
+                return self.symbol_index.lookup(request['name'])
+            if op == 'source':
+                symbol = self.get_symbol(request['name'])
+                return self.get_source(symbol['file_path']).text(symbol['start_byte'], symbol['end_byte'])
+            if op == 'callers':
+                return self.project_graph.get_callers(self.get_symbol(request['name'])['qualified_name'])
+            if op == 'points':
+                symbol = self.get_symbol(request['name'])
+                source = self.get_source(symbol['file_path'])
+                return {'file_path': symbol['file_path'], 'start': list(source.byte_offset_to_point(symbol['start_byte'])),
+                        'end': list(source.byte_offset_to_point(symbol['end_byte']))}
+            if op == 'snapshot':
+                return pickle.dumps((self.root, list(self.filepaths), self.symbol_index, self.project_graph),
+                                    protocol=pickle.HIGHEST_PROTOCOL)
+            if op == 'shutdown':
+                self.stopped.set()
+                return True
+        raise ValueError(f"Unknown query '{op}'")
+
+    def serve(self, socket_path, watcher):
+        """
+        Answer the queries on the Unix socket and apply the changes seen by the watcher until shutdown or Ctrl-C.
+        """
+        if os.path.exists(socket_path):
+            if is_running(socket_path):
+                raise RuntimeError(f"A daemon is already listening on {socket_path}")
+            os.remove(socket_path)
+        server = socketserver.ThreadingUnixStreamServer(socket_path, RequestHandler)
+        server.daemon_threads = True
+        server.repository = self
+        # the snapshots are pickled, only the user running the daemon may connect
+        os.chmod(socket_path, 0o600)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving {self.root} on {socket_path}")
+        try:
+            while not self.stopped.is_set():
+                changed, rescan = watcher.poll(0.5)
+                if changed or rescan:
+                    self.apply_changes(changed, rescan)
+                    if rescan:
+                        watcher.update_directories(self.directories)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.remove(socket_path)
+            watcher.close()
+
+
+def send_message(file, kind, payload):
+    """
+    Write a message: its kind (b'j' for JSON, b'p' for pickle), its length and its bytes.
+    """
+    file.write(MESSAGE_HEADER.pack(kind, len(payload)) + payload)
+    file.flush()
+
+
+def read_message(file):
+    """
+    Read a message written by send_message and get its kind and bytes.
+    """
+    header = file.read(MESSAGE_HEADER.size)
+    if len(header) < MESSAGE_HEADER.size:
+        raise ConnectionError("The daemon closed the connection")
+    kind, length = MESSAGE_HEADER.unpack(header)
+    return kind, file.read(length)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Answer the queries of a connection, one JSON object per line.
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                result = self.server.repository.handle(json.loads(line))
+                if isinstance(result, bytes):
+                    send_message(self.wfile, b'p', result)
+                    continue
+                payload = {'result': result}
+            except Exception as e:
+                payload = {'error': f"{type(e).__name__}: {e}"}
+            send_message(self.wfile, b'j', json.dumps(payload).encode('utf-8'))
+
+
+class DaemonClient:
+    """
+    Connection to a running daemon, see RepositoryDaemon.handle for the queries.
+    Raises a PermissionError if the daemon does not belong to the current user, see check_peer.
+    """
+    def __init__(self, socket_path, timeout=None):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        try:
+            self.socket.connect(socket_path)
+            check_peer(self.socket, socket_path)
+        except OSError:
+            self.socket.close()
+            raise
+        self.file = self.socket.makefile('rwb')
+
+    def query(self, op, **args):
+        """
+        Send a query and get its result, raising a RuntimeError with the error of the daemon if it failed.
+        """
+        self.file.write(json.dumps({'op': op, **args}).encode('utf-8') + b'\n')
+        self.file.flush()
+        kind, payload = read_message(self.file)
+        if kind == b'p':
+            return pickle.loads(payload)
+        response = json.loads(payload)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response['result']
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+def is_running(socket_path):
+    """
+    Check if a daemon answers on the socket.
+    """
+    try:
+        client = DaemonClient(socket_path, timeout=1)
+    except OSError:
+        return False
+    try:
+        client.query('ping')
+        return True
+    except (OSError, RuntimeError):
+        return False
+    finally:
+        client.close()
+
+
+def load_snapshot(socket_path, directory):
+    """
+    Get the python files, symbol index and project call graph of the directory from its daemon, or None if no daemon
+    serving that directory answers on the socket.
+    """
+    try:
+        client = DaemonClient(socket_path, timeout=60)
+    except PermissionError as e:
+        print(f"Not using the daemon: {e}, loading the repository")
+        return None
+    except OSError:
+        print(f"No daemon on {socket_path}, loading the repository")
+        return None
+    try:
+        root, filepaths, symbol_index, project_graph = client.query('snapshot')
+    except (OSError, RuntimeError) as e:
+        print(f"Error loading the repository from the daemon: {e}")
+        return None
+    finally:
+        client.close()
+    if os.path.realpath(root) != os.path.realpath(directory):
+        print(f"The daemon on {socket_path} serves {root}, loading the repository")
+        return None
+    return filepaths, symbol_index, project_graph
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the indexes of a repository in memory and answer queries about it.")
+    parser.add_argument('repo', help="path to the repository")
+    parser.add_argument('--socket', default=None, help="Unix socket to listen on, derived from the repository path by default")
+    parser.add_argument('--poll', type=float, default=None, help="poll the files every this many seconds instead of using inotify")
+    parser.add_argument('--workers', type=int, default=None, help="processes parsing the files, all the cores by default")
+    parser.add_argument('--no-cache', action='store_true', help="do not use the parse cache")
+    parser.add_argument('--query', nargs='+', metavar=('OP', 'NAME'),
+                        help="send a query (ping, lookup, source, callers, points, shutdown) to the running daemon and print its result")
+    args = parser.parse_args()
+
+    socket_path = args.socket or get_socket_path(args.repo)
+    if args.query:
+        client = DaemonClient(socket_path)
+        try:
+            result = client.query(args.query[0], **({'name': args.query[1]} if len(args.query) > 1 else {}))
+        except RuntimeError as e:
+            print(e)
+            sys.exit(1)
+        finally:
+            client.close()
+        print(result if isinstance(result, str) else json.dumps(result, indent=2))
+        sys.exit(0)
+
+    cache = None if args.no_cache else ParseCache()
+    daemon = RepositoryDaemon(args.repo, args.workers, cache)
+    daemon.serve(socket_path, make_watcher(daemon.root, daemon.directories, daemon.filepaths, args.poll))
+    if cache is not None:
+        cache.close()
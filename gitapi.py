@@ -1,33 +1,77 @@
 import os
+import hashlib
 import subprocess
-import requests
 from dotenv import load_dotenv
+import metrics
 
 # Load environment variables from a .env file
 load_dotenv()
 
+# files checked out by the fast clones, the pipeline only reads the Python sources and the .gitignore files
+SPARSE_PATTERNS = ['*.py', '.gitignore']
+# local repositories do not serve filtered fetches unless their upload-pack is told to
+LOCAL_UPLOAD_PACK = 'git -c uploadpack.allowFilter=true upload-pack'
+
+
+def is_local_source(repo_url):
+    """
+    Check if the repository is a local path or a file:// URL, which can be cloned without a token or network.
+    """
+    return repo_url.startswith('file://') or os.path.isdir(repo_url)
+
+
+def get_fetch_url(repo_url):
+    """
+    Get the URL to fetch the repository from, local paths become file:// URLs as git ignores --depth and --filter
+    when cloning a plain path.
+    """
+    if not repo_url.startswith('file://') and os.path.isdir(repo_url):
+        return 'file://' + os.path.abspath(repo_url)
+    return repo_url
+
+
+def run_git(args, cwd=None):
+    """
+    Run a git command and get its output, raising CalledProcessError if it fails.
+    """
+    return subprocess.run(['git'] + args, cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
 class GitHubAPI:
-    def __init__(self):
+    def __init__(self, require_token=True):
+        """
+        require_token=False allows a missing GH_TOKEN, e.g. to clone local repositories.
+        """
         self.token = os.getenv("GH_TOKEN")
-        if not self.token:
+        if not self.token and require_token:
             raise ValueError("GitHub token not found. Please set GH_TOKEN in the .env file.")
         self.headers = {
             'Authorization': f'token {self.token}',
         }
 
-    def clone_repo(self, repo_url, clone_dir=None):
+        self.last_sync = None
+
+    def get_clone_path(self, repo_url, clone_dir=None):
+        """
+        Get the directory the repository is cloned to: its name in clone_dir or in the working directory.
+        """
+        repo_name = get_fetch_url(repo_url).rstrip('/').split('/')[-1].replace('.git', '')
+        return os.path.join(clone_dir or os.getcwd(), repo_name)
+
+    def clone_repo(self, repo_url, clone_dir=None, fast=False, mirror_dir=None):
         """
         Clones a GitHub repository given its URL and returns the path to the cloned directory.
+        fast=True makes or updates a shallow sparse clone through a local mirror instead, see sync_repo, and keeps
+        its report in last_sync.
         """
         if not repo_url:
             raise ValueError("Repository URL must be provided.")
+        if fast:
+            self.last_sync = self.sync_repo(repo_url, clone_dir, mirror_dir)
+            return self.last_sync['path'] if self.last_sync else None
 
         # get name of the repository from the URL and clone directory name
-        repo_name = repo_url.split('/')[-1].replace('.git', '')
-        if clone_dir:
-            clone_path = os.path.join(clone_dir, repo_name)
-        else:
-            clone_path = os.path.join(os.getcwd(), repo_name)
+        clone_path = self.get_clone_path(repo_url, clone_dir)
 
         # Check if the directory exists and is not empty
         if os.path.exists(clone_path) and os.listdir(clone_path):
@@ -35,15 +79,131 @@ class GitHubAPI:
             return clone_path
 
         # Run the git clone command
-        try:
-            subprocess.run(['git', 'clone', repo_url, clone_path], check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Error cloning repository: {e}")
-            return None
+        with metrics.span('clone') as span:
+            try:
+                subprocess.run(['git', 'clone', repo_url, clone_path], check=True)
+            except subprocess.CalledProcessError as e:
+                print(f"Error cloning repository: {e}")
+                span.set(error='CalledProcessError')
+                return None
+            if metrics.enabled:
+                span.set(**get_directory_size(clone_path))
 
         print(f"Repository cloned to: {clone_path}")
         return clone_path
 
+    def get_mirror_path(self, repo_url, mirror_dir=None):
+        """
+        Get the path of the bare mirror of the repository, in mirror_dir, GIT_MIRROR_DIR or .git_mirrors.
+        """
+        mirror_dir = mirror_dir or os.getenv("GIT_MIRROR_DIR", os.path.join(os.getcwd(), '.git_mirrors'))
+        url_hash = hashlib.sha1(get_fetch_url(repo_url).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(mirror_dir, f"{os.path.basename(self.get_clone_path(repo_url))}-{url_hash}.git")
+
+    def fetch_mirror(self, repo_url, mirror_path):
+        """
+        Fetch the latest commit of the default branch into the bare mirror, cloning the mirror on first use.
+        Only the commit and its trees are downloaded, without history or file contents, the blobs are fetched on demand
+        when a clone checks them out. Returns the id of the fetched commit.
+        """
+        fetch_url = get_fetch_url(repo_url)
+        local = fetch_url.startswith('file://')
+        if not os.path.exists(mirror_path):
+            os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+            run_git(['clone', '--quiet', '--bare', '--depth', '1', '--filter=blob:none']
+                    + (['--upload-pack', LOCAL_UPLOAD_PACK] if local else []) + [fetch_url, mirror_path])
+            if local:
+                run_git(['config', 'remote.origin.uploadpack', LOCAL_UPLOAD_PACK], cwd=mirror_path)
+        else:
+            run_git(['fetch', '--quiet', '--depth', '1', '--filter=blob:none', 'origin', 'HEAD'], cwd=mirror_path)
+            # the older commits are then only kept by the clones still checked out at them
+            run_git(['update-ref', 'HEAD', 'FETCH_HEAD'], cwd=mirror_path)
+        return run_git(['rev-parse', 'HEAD'], cwd=mirror_path).strip()
+
+    def is_mirror_worktree(self, clone_path, mirror_path):
+        """
+        Check if the directory is a checkout made from the mirror by sync_repo.
+        """
+        try:
+            common_dir = run_git(['rev-parse', '--path-format=absolute', '--git-common-dir'], cwd=clone_path).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return False
+        return os.path.realpath(common_dir) == os.path.realpath(mirror_path)
+
+    def sync_repo(self, repo_url, clone_dir=None, mirror_dir=None):
+        """
+        Make or update a fast clone of the repository: a sparse checkout of its Python sources at the latest commit, as a
+        worktree of a shallow, blob filtered bare mirror. Later syncs fetch the new commit into the mirror and move the
+        checkout to it, keeping the local changes, instead of cloning again.
+        The repository can be a URL, a file:// URL or a local path.
+        Returns the report of the sync: the 'path' of the checkout, the 'commit' it is at and the 'previous' one (None on
+        the first sync), the Python files 'changed' between them (all of them on the first sync), the files with
+        'local_changes'. Returns None if the sync failed.
+        """
+        if not repo_url:
+            raise ValueError("Repository URL must be provided.")
+        clone_path = os.path.abspath(self.get_clone_path(repo_url, clone_dir))
+        mirror_path = os.path.abspath(self.get_mirror_path(repo_url, mirror_dir))
+        with metrics.span('sync') as span:
+            try:
+                commit = self.fetch_mirror(repo_url, mirror_path)
+                if os.path.exists(clone_path) and os.listdir(clone_path):
+                    if not self.is_mirror_worktree(clone_path, mirror_path):
+                        print(f"Directory '{clone_path}' already exists and is not a fast clone. Skipping sync.")
+                        return None
+                    previous = run_git(['rev-parse', 'HEAD'], cwd=clone_path).strip()
+                    if previous != commit:
+                        # a plain checkout refuses to overwrite local changes to the files the new commit changes
+                        run_git(['checkout', '--quiet', '--detach', commit], cwd=clone_path)
+                    changed = run_git(['diff', '--name-only', '--no-renames', '-z', previous, commit, '--', '*.py'],
+                                      cwd=mirror_path).split('\0')
+                else:
+                    previous = None
+                    run_git(['worktree', 'prune'], cwd=mirror_path)
+                    run_git(['worktree', 'add', '--quiet', '--no-checkout', '--detach', clone_path, commit], cwd=mirror_path)
+                    run_git(['sparse-checkout', 'set', '--no-cone'] + SPARSE_PATTERNS, cwd=clone_path)
+                    run_git(['read-tree', '-mu', 'HEAD'], cwd=clone_path)
+                    changed = run_git(['ls-files', '-z', '--', '*.py'], cwd=clone_path).split('\0')
+                local_changes = get_local_changes(clone_path)
+            except subprocess.CalledProcessError as e:
+                print(f"Error syncing repository: {e.stderr.strip() or e}")
+                span.set(error='CalledProcessError')
+                return None
+            changed = [os.path.join(clone_path, path) for path in changed if path]
+            span.set(files=len(changed))
+
+        if previous is None:
+            print(f"Repository cloned to: {clone_path} ({commit[:10]}, {len(changed)} Python files)")
+        else:
+            print(f"Repository synced: {clone_path} ({previous[:10]} -> {commit[:10]}, {len(changed)} Python files changed)")
+            for path in changed:
+                print(f"  {os.path.relpath(path, clone_path)}")
+        if local_changes:
+            print(f"Python files with local changes: {len(local_changes)}")
+        return {'path': clone_path, 'commit': commit, 'previous': previous, 'changed': changed,
+                'local_changes': local_changes}
+
+
+def get_local_changes(clone_path):
+    """
+    Get the paths of the Python files of the checkout changed since its commit.
+    """
+    status = run_git(['status', '--porcelain', '-z', '--no-renames', '--', '*.py'], cwd=clone_path)
+    return [os.path.join(clone_path, entry[3:]) for entry in status.split('\0') if entry]
+
+
+def get_directory_size(path):
+    """
+    Get the number of files in the directory tree and their total size as bytes_written.
+    """
+    files = 0
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, filename))
+    return {'files': files, 'bytes_written': size}
+
 # Example usage
 if __name__ == "__main__":
     github_api = GitHubAPI()
@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import random
+import argparse
+import tracemalloc
+import numpy as np
+import networkx as nx
+
+# graphs below this size get a force directed layout, larger ones the linear time grouped layout
+# networkx switches spring_layout to its scipy based solver from 500 nodes, and scipy is not a dependency
+MAX_SPRING_NODES = 500
+# graphs up to this size get node labels and arrowheads, larger ones are drawn with WebGL and hover text only
+MAX_LABELED_NODES = 200
+GOLDEN_ANGLE = np.pi * (3 - np.sqrt(5))
+# extensions of the files the graph can be exported to
+OUTPUT_FORMATS = ('.html', '.dot', '.gv', '.json')
+
+
+def get_group(name, symbol_index=None, by='module'):
+    """
+    Get the module (or, with by='class', the class of methods and the module of plain functions) a qualified name belongs to.
+    Without a symbol index the group is the qualified name without its last part.
+    """
+    symbol = symbol_index.symbols.get(name) if symbol_index is not None else None
+    if symbol is None:
+        return name.rsplit('.', 1)[0] if '.' in name else name
+    if by == 'class' and symbol.get('class_name'):
+        return symbol['class_name']
+    return symbol_index.module_name(symbol['file_path']) or '<root>'
+
+
+def collapse_graph(graph, symbol_index=None, by='module'):
+    """
+    Collapse the call graph into a graph of modules or classes, see get_group.
+    Group nodes have the number of functions they hold as 'size' and the calls made inside them as 'internal_calls',
+    edges have the number of call graph edges between the two groups as 'weight'.
+    """
+    groups = {name: get_group(name, symbol_index, by) for name in graph.nodes()}
+    collapsed = nx.DiGraph()
+    for group in groups.values():
+        if group not in collapsed:
+            collapsed.add_node(group, size=0, internal_calls=0)
+        collapsed.nodes[group]['size'] += 1
+    for caller, callee in graph.edges():
+        source, target = groups[caller], groups[callee]
+        if source == target:
+            collapsed.nodes[source]['internal_calls'] += 1
+        elif collapsed.has_edge(source, target):
+            collapsed.edges[source, target]['weight'] += 1
+        else:
+            collapsed.add_edge(source, target, weight=1)
+    return collapsed
+
+
+def sunflower(count):
+    """
+    Get count points spread evenly over a disc of radius sqrt(count), the first ones in the middle.
+    """
+    i = np.arange(count) + 0.5
+    radius = np.sqrt(i)
+    theta = i * GOLDEN_ANGLE
+    return np.column_stack((radius * np.cos(theta), radius * np.sin(theta)))
+
+
+def grouped_layout(graph, groups):
+    """
+    Lay the nodes out in linear time: every group gets a square sized by its number of nodes, the squares are packed
+    in rows, and the nodes of a group are spread over its square with the most connected ones in the middle.
+    groups maps every node to its group.
+    Returns the node list and an array of their (x, y) positions in the same order.
+    """
+    members = {}
+    for node in graph.nodes():
+        members.setdefault(groups[node], []).append(node)
+    degree = dict(graph.degree())
+    order = sorted(members, key=lambda group: (-len(members[group]), str(group)))
+    row_width = 1.5 * np.sqrt(graph.number_of_nodes())
+    nodes = []
+    blocks = []
+    x = y = row_height = 0.0
+    for group in order:
+        group_nodes = sorted(members[group], key=lambda node: -degree[node])
+        side = 2 * np.sqrt(len(group_nodes)) + 2
+        if x > 0 and x + side > row_width:
+            x, y, row_height = 0.0, y + row_height, 0.0
+        blocks.append(sunflower(len(group_nodes)) + (x + side / 2, y + side / 2))
+        nodes.extend(group_nodes)
+        x += side
+        row_height = max(row_height, side)
+    positions = np.concatenate(blocks) if blocks else np.zeros((0, 2))
+    return nodes, positions
+
+
+def layout_graph(graph, groups=None, method='auto'):
+    """
+    Get the (x, y) position of every node of the graph.
+    method is 'spring' (force directed, for small graphs), 'grouped' (see grouped_layout) or 'auto' to choose by size.
+    groups maps the nodes to their groups for the grouped layout, by default their qualified name without its last part.
+    """
+    if method == 'auto':
+        method = 'spring' if graph.number_of_nodes() < MAX_SPRING_NODES else 'grouped'
+    if method == 'spring':
+        pos = nx.spring_layout(graph, seed=0) if graph.number_of_nodes() else {}
+        return {node: (float(x), float(y)) for node, (x, y) in pos.items()}
+    if groups is None:
+        groups = {node: get_group(str(node)) for node in graph.nodes()}
+    nodes, positions = grouped_layout(graph, groups)
+    return dict(zip(nodes, map(tuple, positions.tolist())))
+
+
+def get_node_label(graph, node):
+    """
+    Get the hover text of a node with its size and call counts if it is a collapsed group.
+    """
+    data = graph.nodes[node]
+    if 'size' in data:
+        return f"{node}<br>{data['size']} functions, {data['internal_calls']} internal calls"
+    return str(node)
+
+
+def build_figure(graph, pos, title=None):
+    """
+    Build the plotly figure of the graph with all the edges in a single trace.
+    Small graphs get node labels and arrowheads, larger ones are drawn with WebGL and show the names on hover only.
+    """
+    # plotly is only loaded when a graph is drawn
+    import plotly.graph_objects as go
+    nodes = list(graph.nodes())
+    index = {node: i for i, node in enumerate(nodes)}
+    xy = np.array([pos[node] for node in nodes], dtype=float).reshape(-1, 2)
+    edges = np.array([(index[caller], index[callee]) for caller, callee in graph.edges()], dtype=np.int64).reshape(-1, 2)
+    # every edge is (start, end, gap) so one trace draws all of them
+    edge_xy = np.full((len(edges) * 3, 2), np.nan)
+    edge_xy[0::3] = xy[edges[:, 0]]
+    edge_xy[1::3] = xy[edges[:, 1]]
+    labeled = len(nodes) <= MAX_LABELED_NODES
+    scatter = go.Scatter if labeled else go.Scattergl
+    edge_trace = scatter(x=edge_xy[:, 0], y=edge_xy[:, 1], mode='lines', hoverinfo='none',
+                         line=dict(width=1, color='#888'))
+    if labeled:
+        # an arrowhead at the end of every edge, pointing away from the previous point
+        edge_trace.update(mode='lines+markers', marker=dict(symbol='arrow', angleref='previous', color='#888',
+                                                            size=np.tile([0, 12, 0], len(edges))))
+    sizes = np.array([graph.nodes[node].get('size', 1) for node in nodes], dtype=float)
+    node_trace = scatter(
+        x=xy[:, 0], y=xy[:, 1],
+        mode='markers+text' if labeled else 'markers',
+        text=[get_node_label(graph, node) for node in nodes],
+        textposition='top center',
+        hoverinfo='text',
+        marker=dict(size=np.clip(6 + 2 * np.sqrt(sizes), 6, 40), color='skyblue', line=dict(width=1))
+    )
+    return go.Figure(data=[edge_trace, node_trace],
+                     layout=go.Layout(
+                         title=title,
+                         showlegend=False,
+                         hovermode='closest',
+                         margin=dict(b=20, l=5, r=5, t=40),
+                         xaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
+                         yaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
+                         height=800
+                     ))
+
+
+def quote_dot(text):
+    """
+    Quote a name as a DOT identifier.
+    """
+    return '"' + str(text).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def export_dot(graph, path, pos=None):
+    """
+    Write the graph in the Graphviz DOT format, with the positions as pinned 'pos' attributes if given.
+    """
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write("digraph calls {\n")
+        for node, data in graph.nodes(data=True):
+            attributes = []
+            if 'size' in data:
+                label = f"{node} ({data['size']})"
+                attributes.append(f"label={quote_dot(label)}")
+            if pos is not None:
+                attributes.append(f'pos="{pos[node][0]:.3f},{pos[node][1]:.3f}!"')
+            file.write(f"  {quote_dot(node)}{' [' + ', '.join(attributes) + ']' if attributes else ''};\n")
+        for caller, callee, data in graph.edges(data=True):
+            weight = f" [weight={data['weight']}]" if 'weight' in data else ''
+            file.write(f"  {quote_dot(caller)} -> {quote_dot(callee)}{weight};\n")
+        file.write("}\n")
+
+
+def export_json(graph, path, pos=None):
+    """
+    Write the nodes with their attributes and positions, and the edges with their attributes, as JSON.
+    """
+    nodes = []
+    for node, data in graph.nodes(data=True):
+        entry = {'id': node}
+        entry.update((key, value) for key, value in data.items() if isinstance(value, (str, int, float)))
+        if pos is not None:
+            entry['x'], entry['y'] = pos[node]
+        nodes.append(entry)
+    edges = []
+    for caller, callee, data in graph.edges(data=True):
+        entry = {'source': caller, 'target': callee}
+        entry.update((key, value) for key, value in data.items() if isinstance(value, (str, int, float)))
+        edges.append(entry)
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(json.dumps({'nodes': nodes, 'edges': edges}))
+
+
+def render_graph(graph, output=None, symbol_index=None, collapse=None, layout='auto', title=None, show=False, trace_memory=True):
+    """
+    Lay out the whole call graph in one view and export it to output (.html, .dot/.gv or .json, chosen by extension)
+    and/or show it in the browser.
+    collapse is None, 'module' or 'class' to draw one node per module or class instead of one per function.
+    Returns the report: node and edge counts, layout and render times in seconds and the peak memory in MB.
+    Tracing the memory slows the rendering down, trace_memory=False times it without tracing and reports no memory.
+    """
+    extension = os.path.splitext(output)[1].lower() if output else None
+    if extension not in (None,) + OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported graph output format: {output}")
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    if collapse:
+        graph = collapse_graph(graph, symbol_index, collapse)
+        groups = {node: get_group(node) for node in graph.nodes()}
+    else:
+        groups = {node: get_group(node, symbol_index) for node in graph.nodes()}
+    pos = layout_graph(graph, groups, layout)
+    layout_time = time.perf_counter() - start
+    if extension in ('.dot', '.gv'):
+        export_dot(graph, output, pos)
+    elif extension == '.json':
+        export_json(graph, output, pos)
+    if extension == '.html' or show:
+        figure = build_figure(graph, pos, title)
+        if extension == '.html':
+            figure.write_html(output, include_plotlyjs=True)
+        if show:
+            figure.show()
+    render_time = time.perf_counter() - start - layout_time
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return {
+        'nodes': graph.number_of_nodes(),
+        'edges': graph.number_of_edges(),
+        'layout_time': layout_time,
+        'render_time': render_time,
+        'peak_memory_mb': peak_memory,
+    }
+
+
+def print_render_report(report):
+    """
+    Print the size of the rendered graph, the time it took and its peak memory.
+    """
+    memory = f", peak memory {report['peak_memory_mb']:.1f} MB" if report['peak_memory_mb'] is not None else ''
+    print(f"Rendered {report['nodes']} nodes and {report['edges']} edges: layout {report['layout_time']:.2f}s, "
+          f"render {report['render_time']:.2f}s{memory}")
+
+
+def synthetic_graph(nodes, calls_per_function=3, functions_per_module=50, seed=0):
+    """
+    Build a random call graph of nodes functions spread over modules, most calls staying inside their package,
+    to measure the rendering of large repositories.
+    """
+    rng = random.Random(seed)
+    names = [f"pkg{i // (functions_per_module * 20)}.mod{i // functions_per_module}.func{i}" for i in range(nodes)]
+    graph = nx.DiGraph()
+    graph.add_nodes_from(names)
+    for i, name in enumerate(names):
+        for _ in range(calls_per_function):
+            # three calls out of four go to a function at most a package away
+            if rng.random() < 0.75:
+                j = min(nodes - 1, max(0, i + rng.randint(-functions_per_module * 20, functions_per_module * 20)))
+            else:
+                j = rng.randrange(nodes)
+            if j != i:
+                graph.add_edge(name, names[j])
+    return graph
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the call graph of a whole repository and report the time and memory it takes.")
+    parser.add_argument('repo', nargs='?', help="path to the repository")
+    parser.add_argument('--output', default='call_graph.html', help="file to write, .html, .dot/.gv or .json")
+    parser.add_argument('--collapse', choices=['module', 'class'], default=None, help="draw one node per module or class")
+    parser.add_argument('--layout', choices=['auto', 'spring', 'grouped'], default='auto', help="layout algorithm")
+    parser.add_argument('--show', action='store_true', help="also open the graph in the browser")
+    parser.add_argument('--synthetic', type=int, default=None, help="render a random graph of this many functions instead")
+    parser.add_argument('--no-memory', action='store_true', help="do not trace the memory, which slows the rendering down")
+    parser.add_argument('--workers', type=int, default=None, help="processes parsing the files, all the cores by default")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        graph, symbol_index, title = synthetic_graph(args.synthetic), None, f"synthetic graph of {args.synthetic} functions"
+    elif args.repo:
+        from main import load_repository
+        _, _, symbol_index, project_graph = load_repository(args.repo, args.workers)
+        graph, title = project_graph.to_networkx(), args.repo
+    else:
+        parser.error("give the path to a repository or --synthetic")
+    report = render_graph(graph, args.output, symbol_index, args.collapse, args.layout, title, args.show, not args.no_memory)
+    print_render_report(report)
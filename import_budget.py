@@ -0,0 +1,43 @@
+import os
+import sys
+import json
+import subprocess
+
+# modules of the parse-only path: scanning, parsing and indexing a repository, and the frontends importing them
+PARSE_ONLY_MODULES = ['repo_scan', 'symbol_index', 'project_graph', 'parse_cache', 'main', 'batch']
+# stacks that must only be loaded when a graph is drawn or a request is sent to the llm
+LAZY_MODULES = ['matplotlib', 'plotly', 'langchain', 'langchain_groq', 'groq']
+
+CHILD_CODE = """
+import sys, json, time
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+elapsed = time.perf_counter() - start
+print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+
+def measure_imports(runs=3):
+    """
+    Import the parse-only modules in fresh interpreters and get the best import time and the lazy stacks loaded.
+    """
+    code = CHILD_CODE.format(modules=PARSE_ONLY_MODULES, lazy=LAZY_MODULES)
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return min(result['elapsed'] for result in results), sorted(set().union(*(result['loaded'] for result in results)))
+
+
+if __name__ == "__main__":
+    # budget in seconds, from the command line or IMPORT_BUDGET
+    budget = float(sys.argv[1] if len(sys.argv) > 1 else os.getenv("IMPORT_BUDGET", "0.5"))
+    elapsed, loaded = measure_imports()
+    print(f"parse-only imports: {elapsed:.3f}s (budget {budget:.3f}s)")
+    if loaded:
+        print(f"FAIL: loaded at import time: {', '.join(loaded)}")
+    if elapsed > budget:
+        print("FAIL: import time over budget")
+    sys.exit(1 if loaded or elapsed > budget else 0)
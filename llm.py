@@ -1,7 +1,18 @@
 import os
-from langchain.prompts import ChatPromptTemplate
-from langchain_groq import ChatGroq
+import time
+import random
+import asyncio
 from dotenv import load_dotenv
+from llm_cache import ResponseCache
+import metrics
+
+MODEL = "llama3-8b-8192"
+SYSTEM_PROMPT = "You are a software engineer"
+
+response_cache = None
+llm_client = None
+# latency and token counts of every call, see print_llm_stats
+llm_stats = []
 
 
 def load_environment_variable():
@@ -22,26 +33,233 @@ def load_environment_variable():
         return None
 
 
-def get_llm_response(prompt_user):
+def get_response_cache():
+    """
+    Get the response cache configured from the environment, or None if LLM_CACHE is 'off'
+    LLM_CACHE_DIR sets the directory of the disk tier and LLM_REPLAY=1 serves recorded responses only, without network
+    """
+    global response_cache
+    if response_cache is None:
+        load_dotenv()
+        if os.getenv("LLM_CACHE", "on").lower() == "off":
+            return None
+        response_cache = ResponseCache(os.getenv("LLM_CACHE_DIR", os.path.join(os.getcwd(), ".llm_cache")),
+                                       replay=os.getenv("LLM_REPLAY", "0") == "1")
+    return response_cache
+
+
+class LLMClient:
+    """ 
+    Long lived chat model client. The ChatGroq client and the prompt chain are built on the first call and reused for
+    every later one, so the HTTP connections to the API stay open between calls.
+    base_url points the client at another server speaking the same API, e.g. a local stand-in.
+    """
+    def __init__(self, model=MODEL, system=SYSTEM_PROMPT, api_key=None, base_url=None):
+        self.model = model
+        self.system = system
+        self.api_key = api_key
+        self.base_url = base_url
+        self.chain = None
+
+    def connect(self):
+        """ 
+        Build the ChatGroq client and the prompt chain.
+        """
+        # langchain takes a while to import, so it is only loaded once a request is actually sent
+        from langchain.prompts import ChatPromptTemplate
+        from langchain_groq import ChatGroq
+        api_key = self.api_key or load_environment_variable()
+        llm = ChatGroq(model=self.model, groq_api_key=api_key, groq_api_base=self.base_url)
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", self.system),
+            ("human", "{text}")
+        ])
+        self.chain = prompt | llm
+
+    def invoke(self, prompt, on_token=None):
+        """ 
+        Get the response text, input tokens and output tokens for the prompt.
+        If on_token is given the response is streamed and on_token is called with each chunk as it arrives.
+        """
+        if self.chain is None:
+            self.connect()
+        if on_token is None:
+            message = self.chain.invoke({"text": prompt})
+        else:
+            message = None
+            for chunk in self.chain.stream({"text": prompt}):
+                on_token(chunk.content)
+                message = chunk if message is None else message + chunk
+            if message is None:
+                return '', None, None
+        usage = getattr(message, 'usage_metadata', None) or {}
+        return message.content, usage.get('input_tokens'), usage.get('output_tokens')
+
+
+class FakeLLMClient:
     """ 
-    Get response from llama3-8b- model using the given prompt
+    In-process stand-in for LLMClient that never touches the network, for tests, CI and benchmarks.
+    Answers with the given response, or else with the code at the end of the prompt unchanged, after sleeping latency seconds.
+    Token counts are whitespace separated words.
     """
-    api = load_environment_variable()
-    llm = ChatGroq(model="llama3-8b-8192", groq_api_key=api)
+    def __init__(self, response=None, latency=0.0, model="fake"):
+        self.model = model
+        self.response = response
+        self.latency = latency
 
-    system = "You are a software engineer"
-    human="{text}"
-    prompt=ChatPromptTemplate.from_messages([
-        ("system", system),
-        ("human", human)
-    ]
-    )
+    def invoke(self, prompt, on_token=None):
+        """ 
+        Get the response text, input tokens and output tokens for the prompt.
+        """
+        time.sleep(self.latency)
+        response = self.response
+        if response is None:
+            response = prompt
+            for marker in ("Caller code:\n", "Call sites-\n", "function-\n"):
+                if marker in prompt:
+                    response = prompt.rsplit(marker, 1)[1]
+                    break
+        if on_token is not None:
+            for line in response.splitlines(True):
+                on_token(line)
+        return response, len(prompt.split()), len(response.split())
+
+
+def get_llm_client():
+    """ 
+    Get the llm client shared by every call, created from the environment on first use
+    LLM_BACKEND=fake uses FakeLLMClient (LLM_FAKE_RESPONSE, LLM_FAKE_LATENCY), otherwise Groq with LLM_MODEL and LLM_BASE_URL
+    """
+    global llm_client
+    if llm_client is None:
+        load_dotenv()
+        if os.getenv("LLM_BACKEND", "groq").lower() == "fake":
+            llm_client = FakeLLMClient(os.getenv("LLM_FAKE_RESPONSE"), float(os.getenv("LLM_FAKE_LATENCY", "0")))
+        else:
+            llm_client = LLMClient(model=os.getenv("LLM_MODEL", MODEL), base_url=os.getenv("LLM_BASE_URL"))
+    return llm_client
+
+
+def set_llm_client(client):
+    """ 
+    Replace the shared llm client, e.g. with a fake. Any object with a model attribute and an invoke(prompt, on_token) method works.
+    """
+    global llm_client
+    llm_client = client
+
+
+def get_llm_response(prompt_user, attempt=0, use_cache=True, on_token=None):
+    """ 
+    Get response from the llm client (llama3-8b- model by default) using the given prompt
+    attempt is the number of responses to the same prompt already rejected, so a re-ask does not get the cached one again
+    use_cache=False always calls the model and does not record the response
+    on_token is called with the response chunks as they stream in (once with the whole response if it is cached)
+    """
+    client = get_llm_client()
+    cache = get_response_cache() if use_cache else None
+    with metrics.span('llm_response', model=client.model, attempt=attempt) as span:
+        start = time.perf_counter()
+        if cache is not None:
+            cached = cache.get(client.model, SYSTEM_PROMPT, prompt_user, attempt)
+            if cached is not None:
+                llm_stats.append({'model': client.model, 'latency': time.perf_counter() - start, 'input_tokens': None,
+                                  'output_tokens': None, 'cached': True})
+                span.set(cached=True)
+                if on_token is not None:
+                    on_token(cached)
+                return cached
 
-    chain=prompt | llm
+        response, input_tokens, output_tokens = client.invoke(prompt_user, on_token)
+        llm_stats.append({'model': client.model, 'latency': time.perf_counter() - start, 'input_tokens': input_tokens,
+                          'output_tokens': output_tokens, 'cached': False})
+        span.set(cached=False, input_tokens=input_tokens, output_tokens=output_tokens)
+        if cache is not None:
+            cache.put(client.model, SYSTEM_PROMPT, prompt_user, response, attempt)
+    return response
+
+
+def is_rate_limit_error(error):
+    """ 
+    Check if the error raised by the llm client means the API is rate limiting the requests
+    """
+    return getattr(error, 'status_code', None) == 429 or type(error).__name__ == 'RateLimitError'
+
+
+async def get_llm_response_async(prompt_user, semaphore, retries=5, backoff=1.0, attempt=0):
+    """ 
+    Get response from the llm in a worker thread once the semaphore allows it, retrying with exponential backoff
+    and jitter while the API is rate limiting the requests
+    attempt is passed to get_llm_response
+    """
+    for retry in range(retries + 1):
+        async with semaphore:
+            try:
+                return await asyncio.to_thread(get_llm_response, prompt_user, attempt)
+            except Exception as e:
+                if not is_rate_limit_error(e) or retry == retries:
+                    raise
+        await asyncio.sleep(backoff * 2 ** retry + random.uniform(0, backoff))
+
+
+async def get_llm_responses(prompts, concurrency=4, attempts=None):
+    """ 
+    Send all the prompts with at most concurrency requests in flight and yield (index of the prompt, response)
+    as the responses arrive
+    attempts gives the attempt of every prompt, see get_llm_response, so the same prompt can be sent several times
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    attempts = attempts or [0] * len(prompts)
+
+    async def request(i, prompt):
+        return i, await get_llm_response_async(prompt, semaphore, attempt=attempts[i])
+
+    for response in asyncio.as_completed([request(i, prompt) for i, prompt in enumerate(prompts)]):
+        yield await response
+
+
+def get_llm_candidates(prompt_user, count, attempt=0):
+    """ 
+    Ask the llm for count responses to the same prompt at once, as the attempts attempt to attempt + count - 1, and
+    yield them in attempt order, each one as soon as it and the ones before it arrived, so a replayed session picks
+    the same candidate
+    Closing the generator, e.g. once a candidate is accepted, does not wait for the others: the requests not sent yet
+    are cancelled and the ones in flight finish in the background, their responses are recorded in the response cache
+    but their tokens are still paid for
+    """
+    responses = get_llm_responses([prompt_user] * count, count, [attempt + i for i in range(count)])
+
+    async def cancel():
+        await responses.aclose()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    loop = asyncio.new_event_loop()
+    received = {}
+    try:
+        for i in range(count):
+            while i not in received:
+                index, response = loop.run_until_complete(anext(responses))
+                received[index] = response
+            yield received.pop(i)
+    finally:
+        loop.run_until_complete(cancel())
+        # closing the loop does not join the threads of the requests in flight
+        loop.close()
+
+
+def print_llm_stats():
+    """ 
+    Print the number of llm calls, their total latency and token counts
+    """
+    calls = [stat for stat in llm_stats if not stat['cached']]
+    latency = sum(stat['latency'] for stat in calls)
+    input_tokens = sum(stat['input_tokens'] or 0 for stat in calls)
+    output_tokens = sum(stat['output_tokens'] or 0 for stat in calls)
+    print(f"LLM calls: {len(calls)} ({len(llm_stats) - len(calls)} cached), latency: {latency:.2f}s, "
+          f"tokens: {input_tokens} in / {output_tokens} out")
 
-    prompt = prompt_user
-    response = chain.invoke({"text": prompt}) 
-    return response.content
 
 
     
\ No newline at end of file
@@ -0,0 +1,84 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Content addressed cache of llm responses keyed by model, system prompt and user prompt.
+    Recent entries are kept in an in-memory LRU in front of a directory of JSON files.
+    Every entry keeps the list of responses indexed by attempt so a re-asked prompt (attempt 1, 2, ...) gets a new
+    response instead of the rejected one, and a recorded session replays in the same order even if the concurrent
+    requests completed in another order.
+    In replay mode a missing response raises a LookupError instead of calling the model.
+    """
+    def __init__(self, directory, max_entries=256, replay=False):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.replay = replay
+        self.memory = OrderedDict()
+        # responses may be requested from several threads at once, see get_llm_response_async
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(model, system, prompt):
+        """
+        Get the content hash of the request.
+        """
+        data = json.dumps([model, system, prompt], ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        """
+        Get the entry from the memory tier, or from the disk tier, or None.
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        path = os.path.join(self.directory, f"{key}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as file:
+            entry = json.load(file)
+        self.remember(key, entry)
+        return entry
+
+    def remember(self, key, entry):
+        """
+        Put the entry in the memory tier, dropping the least recently used ones.
+        """
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, model, system, prompt, attempt=0):
+        """
+        Get the response recorded for the given attempt at the request, or None.
+        """
+        with self.lock:
+            entry = self.load(self.key(model, system, prompt))
+        if entry is not None and attempt < len(entry['responses']) and entry['responses'][attempt] is not None:
+            return entry['responses'][attempt]
+        if self.replay:
+            raise LookupError(f"No recorded response for attempt {attempt} of the prompt: {prompt[:80]!r}")
+        return None
+
+    def put(self, model, system, prompt, response, attempt=0):
+        """
+        Record the response to the given attempt at the request, the attempts not recorded yet are left as None.
+        """
+        key = self.key(model, system, prompt)
+        with self.lock:
+            entry = self.load(key) or {'model': model, 'system': system, 'prompt': prompt, 'responses': []}
+            responses = entry['responses']
+            responses.extend([None] * (attempt + 1 - len(responses)))
+            responses[attempt] = response
+            self.remember(key, entry)
+            path = os.path.join(self.directory, f"{key}.json")
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+                json.dump(entry, file, ensure_ascii=False, indent=1)
+            os.replace(f"{path}.tmp", path)
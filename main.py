@@ -1,157 +1,578 @@
-from construct_ast import *
-from llm import *
-from code_editor import *
-from gitapi import *
+import os
+import time
+import asyncio
+import argparse
+from construct_ast import CreateTree
+from llm import get_llm_response, get_llm_responses, get_llm_candidates, print_llm_stats
+from code_editor import CodeEditor, apply_batches
+from gitapi import GitHubAPI, is_local_source
+from symbol_index import SymbolIndex
+from project_graph import ProjectCallGraph
+from repo_scan import scan_python_files, parse_files
+from parse_cache import ParseCache
+from daemon import load_snapshot, get_socket_path
+from validation import check_function_code, check_call_arguments, get_function_definition, get_parameter_names
+from call_context import (get_call_sites, group_call_sites, get_call_site_replacements, get_callees, DEFAULT_CONTEXT_LINES,
+                          DEFAULT_TOKEN_BUDGET)
+import metrics
 
+# rounds of candidates asked for before a response failing the checks is shown anyway
+VALIDATION_ROUNDS = 3
 
-def create_file_graphs(filepath):
+
+def create_file_graphs(filepath, draw=True):
     """ 
     Create and display call graph for a given file
     """
-    print(f"Processing file and displaying graph for: {filepath}")
+    if draw:
+        print(f"Processing file and displaying graph for: {filepath}")
     with open(filepath, 'r', encoding='utf-8') as f:
         code = f.read() 
         tree = CreateTree(code, filepath)
         G, list_functions = tree.call_graph()
-        tree.draw_graph()
+        if draw:
+            tree.draw_graph()
     return tree, list_functions
+
+
+class FileTrees(dict):
+    """ 
+    CreateTree of each file, built on first access so only the files that are drawn or edited get parsed in this process
+    """
+    def __missing__(self, filepath):
+        tree, list_functions = create_file_graphs(filepath, draw=False)
+        self[filepath] = tree
+        return tree
+
+
+def display_repository_graph(project_graph, symbol_index, output=None, collapse=None):
+    """ 
+    Display the call graph of the whole repository in one view, or export it to output (.html, .dot or .json) without
+    opening the browser
+    collapse is None, 'module' or 'class' to draw one node per module or class
+    """
+    # plotly is only loaded when a graph is drawn, numpy is already loaded by the call graphs (see compact_graph)
+    from graph_render import render_graph, print_render_report
+    # tracing the memory would slow down the rendering the span times
+    with metrics.span('render_graph', collapse=collapse) as span:
+        report = render_graph(project_graph.to_networkx(), output, symbol_index, collapse, title=symbol_index.root,
+                              show=output is None, trace_memory=not metrics.enabled)
+        span.set(nodes=report['nodes'], edges=report['edges'])
+    print_render_report(report)
+
+
+def update_indexes(tree, symbol_index, project_graph):
+    """ 
+    Update the symbol index and the project call graph after the tree of a file changed
+    """
+    record = tree.get_file_record()
+    symbol_index.update_file(record)
+    project_graph.update_file(record)
+        
+    
+def load_repository(directory, workers=None, cache=None, daemon=None):
+    """ 
+    Scan the directory once, parse the files in parallel and build the symbol index and project call graph
+    daemon is the socket of a daemon watching the directory, its indexes are loaded instead if it answers
+    Returns the python files, their lazily built trees, the symbol index and the project call graph
+    """
+    tree_dict = FileTrees()
+    if daemon is not None:
+        with metrics.span('daemon_snapshot') as span:
+            snapshot = load_snapshot(daemon, directory)
+            span.set(cached=snapshot is not None)
+        if snapshot is not None:
+            filepaths, symbol_index, project_graph = snapshot
+            return filepaths, tree_dict, symbol_index, project_graph
+    symbol_index = SymbolIndex(directory)
+    with metrics.span('scan') as span:
+        filepaths = scan_python_files(directory)
+        span.set(files=len(filepaths))
+    with metrics.span('parse', files=len(filepaths), workers=workers) as span:
+        records = parse_files(filepaths, workers, cache)
+        span.set(functions=sum(len(record['functions']) for record in records))
+    with metrics.span('index', files=len(records)):
+        for record in records:
+            symbol_index.update_file(record)
+        # resolve the calls across files once every function of the repository is indexed
+        project_graph = ProjectCallGraph(symbol_index)
+        project_graph.update_files(records)
+    return filepaths, tree_dict, symbol_index, project_graph
         
     
-def transform(directory):
+def transform(directory, workers=None, cache=None, concurrency=1, draw=True, graph_output=None, collapse=None,
+              context_lines=DEFAULT_CONTEXT_LINES, token_budget=DEFAULT_TOKEN_BUDGET, daemon=None, candidates=1):
     """ 
     Transform the files of a directory using llm
+    draw=False skips drawing the call graphs, so plotly is never loaded
+    graph_output is a file the updated call graph is exported to instead of being displayed, see display_repository_graph
+    workers is the number of processes parsing the files, all the cores by default
+    cache is an optional ParseCache so the files unchanged since the last run are not parsed again
+    concurrency is the number of caller update requests sent to the llm at once
+    context_lines and token_budget shape the caller update prompts, see update_callers_code
+    daemon is the socket of a daemon the indexes are loaded from, see load_repository
+    candidates is the number of responses asked for at once, only the first one passing the checks is shown
     """
-    tree_dict = {}
-    function_dict = {}
-    # traverse each file in directory and create call graph for each
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.endswith(".py"):
-                filepath = os.path.join(root, file)
-                tree, list_functions = create_file_graphs(filepath)
-                tree_dict[filepath] = tree
-                function_dict[filepath] = list_functions
+    filepaths, tree_dict, symbol_index, project_graph = load_repository(directory, workers, cache, daemon)
+    if draw and graph_output is None:
+        display_repository_graph(project_graph, symbol_index, collapse=collapse)
     
     #prompt the llm using user input                         
-    prompt, function_name = get_user_input_for_llm(function_dict, tree_dict)
-    tree_, filepath_ = get_tree_of_function(function_name, function_dict, tree_dict)
-    response_prev = get_approved_llm_response(prompt, function_dict, tree_dict)
+    prompt, function_name, parameter = get_user_input_for_llm(symbol_index, tree_dict)
+    tree_, filepath_ = get_tree_of_function(function_name, symbol_index, tree_dict)
+    #the response must be a single function with the same name and the added parameter
+    name = symbol_index.lookup(function_name)[0]['name']
+
+    def reprompt(full_prompt_by_user):
+        # the function stays the same, the parameter may change
+        nonlocal parameter
+        prompt, _, parameter = get_user_input_for_llm(symbol_index, tree_dict, full_prompt_by_user, function_name)
+        return prompt, get_function_check(name, parameter)
+
+    response_prev = get_approved_llm_response(prompt, symbol_index, tree_dict,
+                                              check=get_function_check(name, parameter),
+                                              candidates=candidates, reprompt=reprompt)
     #update the code given by llm to the code file
     editor = CodeEditor(filepath_)
-    a = tree_.get_st_and_end_points(function_name)
-    editor.replace_code(a[0],a[1], response_prev)
+    a = get_st_and_end_points_of_symbol(function_name, symbol_index, tree_)
+    edit = editor.replace_code(a[0],a[1], response_prev)
     code = ''
-    with open(filepath_, 'r') as file:
+    with open(filepath_, 'r', encoding='utf-8') as file:
         code = file.read()
     #update the tree as start and end points of functions have now changes
-    tree_.update_tree(code)
+    tree_.update_tree(code, edit)
+    update_indexes(tree_, symbol_index, project_graph)
     
     #update and correct the function calls in the callers of the function
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.endswith(".py"):
-                filepath = os.path.join(root, file)
-                update_callers_code(filepath, function_name, tree_dict[filepath], editor.remove_triple_backticks(response_prev), function_dict, tree_dict)
+    update_callers_code(function_name, editor.remove_triple_backticks(response_prev), symbol_index, project_graph, tree_dict, concurrency,
+                        context_lines, token_budget, parameter, candidates)
     
-    #display the updated call graphs for each file
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.endswith(".py"):
-                filepath = os.path.join(root, file)   
-                tree, list_functions = create_file_graphs(filepath)
-                tree_dict[filepath] = tree
-                function_dict[filepath] = list_functions
+    #display the updated call graph of the repository
+    if draw:
+        display_repository_graph(project_graph, symbol_index, graph_output, collapse)
+    print_llm_stats()
     
-def get_tree_of_function(function_name, function_dict, tree_dict):
+def get_tree_of_function(function_name, symbol_index, tree_dict):
     """ 
     Get the tree of the function from the function name
     """
-    for key in function_dict.keys():
-        if function_name in function_dict[key]:
-            return tree_dict[key], key
-    return None
+    symbols = symbol_index.lookup(function_name)
+    if not symbols:
+        return None
+    return tree_dict[symbols[0]['file_path']], symbols[0]['file_path']
+
+def get_st_and_end_points_of_symbol(function_name, symbol_index, tree):
+    """ 
+    Get the start and end points of the function from its indexed byte range
+    """
+    symbol = symbol_index.lookup(function_name)[0]
+    return (tree.source.byte_offset_to_point(symbol['start_byte']), tree.source.byte_offset_to_point(symbol['end_byte']))
+
+def select_function(function_name, symbol_index):
+    """ 
+    Get the qualified name of the function, asking the user to choose when several functions share the given name
+    """
+    symbols = symbol_index.lookup(function_name)
+    if len(symbols) <= 1:
+        return symbols[0]['qualified_name'] if symbols else function_name
+    print(f"Multiple functions named '{function_name}' found:")
+    for symbol in symbols:
+        print(f"  {symbol['qualified_name']} ({symbol['file_path']})")
+    return select_function(input('Qualified name of function to be modified: '), symbol_index)
                 
-def get_user_input_for_llm(function_dict, tree_dict, full_prompt_by_user=False):
+def get_function_prompt(arg_to_be_added, arg_info, function_code):
+    """ 
+    Get the prompt asking the llm to add a parameter to the function
+    """
+    return (f"Modify/Edit the given function definition to add a '{arg_to_be_added}' parameter to it and update the function accordingly. "
+            f"The '{arg_to_be_added}' parameter should {arg_info}. Generate ONLY the code output for the function.\n"
+            f"function-\n{function_code}")
+                
+def get_user_input_for_llm(symbol_index, tree_dict, full_prompt_by_user=False, function_name=None):
     """ 
     Get user input for llm prompt
     if full_prompt_by_user is False, then get the function name and argument to be added from user to fit into the sample prompt else get the whole prompt from user
+    function_name is the function to be modified, only asked for if it is None
+    Returns the prompt, the qualified name of the function and the parameter to be added (None with a full prompt)
     """
     if not full_prompt_by_user:
         #to get from user
         #name of the function to be modified
         #argument of the function to be added
         #little info about the argument and how it should affect the function
-        function_to_be_modified = input('Name of function to be modified: ')
+        function_to_be_modified = function_name or select_function(input('Name of function to be modified: '), symbol_index)
         arg_to_be_added = input('Parameter to be added: ')
         arg_info = input('Info about the parameter and how it should affect the function: ')
-        tree1, file_path1 = get_tree_of_function(function_to_be_modified, function_dict, tree_dict)
-        function_code = tree1.get_function_from_name(function_to_be_modified)
-        prompt = (f"Modify/Edit the given function definition to add a '{arg_to_be_added}' parameter to it and update the function accordingly. "
-              f"The '{arg_to_be_added}' parameter should {arg_info}. Generate ONLY the code output for the function.\n"
-              f"function-\n{function_code}")
-        return prompt, function_to_be_modified
+        tree1, file_path1 = get_tree_of_function(function_to_be_modified, symbol_index, tree_dict)
+        symbol = symbol_index.lookup(function_to_be_modified)[0]
+        function_code = tree1.source.text(symbol['start_byte'], symbol['end_byte'])
+        prompt = get_function_prompt(arg_to_be_added, arg_info, function_code)
+        return prompt, function_to_be_modified, arg_to_be_added
     else:
-        function_to_be_modified = input('Name of function to be modified: ')
-        return input('Enter the full prompt: '), function_to_be_modified
+        function_to_be_modified = function_name or select_function(input('Name of function to be modified: '), symbol_index)
+        return input('Enter the full prompt: '), function_to_be_modified, None
         
-def get_approved_llm_response(prompt, function_dict, tree_dict):
+def get_checked_response(prompt, check, rounds, attempt=0, response=None, candidates=1, on_token=None, on_rejected=None):
+    """ 
+    Ask the llm for responses to the prompt until check accepts one, in at most rounds rounds of candidates responses
+    check gets a response as received and returns None if it is valid, else the reason it is rejected; without a check
+    the first response is accepted
+    attempt is the number of responses to the prompt already received, see get_llm_response
+    response is an already received response to the prompt to check first
+    on_token gets the chunks of a single response as they arrive, see get_llm_response
+    on_rejected is called with the number of responses rejected in a round and the reason the last one is rejected
+    Returns the last response, the number of responses asked for and the reason it is rejected (None if it is accepted)
+    """
+    received = 0
+    reason = None
+    for _ in range(rounds):
+        if response is not None:
+            responses = [response]
+        elif candidates == 1:
+            responses = [get_llm_response(prompt, attempt=attempt + received, on_token=on_token)]
+        else:
+            # the candidates are checked as they arrive, the slower ones are not waited for once one is accepted
+            responses = get_llm_candidates(prompt, candidates, attempt + received)
+        received += len(responses) if isinstance(responses, list) else candidates
+        rejected = 0
+        for response in responses:
+            reason = check(response) if check is not None else None
+            if reason is None:
+                break
+            rejected += 1
+        if not isinstance(responses, list):
+            responses.close()
+        if reason is None:
+            return response, received, None
+        if on_rejected is not None:
+            on_rejected(rejected, reason)
+        last, response = response, None
+    return last, received, reason
+
+
+def get_valid_response(prompt, check, candidates, attempts, response=None):
+    """ 
+    Get a response to the prompt passing check and print it, asking for candidates responses at once and asking again
+    up to VALIDATION_ROUNDS times, so the responses the checks reject never reach the user, see get_checked_response
+    without a check a single response is streamed as it arrives
+    attempts counts the responses already received per prompt, see get_llm_response
+    response is an already received response to the prompt to check first
+    Returns the response and, if no response passed the checks, the reason the last one is rejected
+    """
+    streamed = response is None and candidates == 1 and check is None
+    response, received, reason = get_checked_response(
+        prompt, check, VALIDATION_ROUNDS, attempts.get(prompt, 0), response, candidates,
+        on_token=(lambda token: print(token, end='', flush=True)) if streamed else None,
+        on_rejected=lambda count, reason: print(f"Rejected {count} response(s): {reason}"))
+    attempts[prompt] = attempts.get(prompt, 0) + received
+    if streamed:
+        print()
+    else:
+        print(response)
+    return response, reason
+
+
+def get_approved_llm_response(prompt, symbol_index, tree_dict, response=None, check=None, candidates=1, reprompt=None):
     """ 
     Get approved llm response from user i.e the user gets option to keep prompting till they get a satisfactory response
+    response is an already received response to the prompt to show first
+    check validates the responses before they are shown and candidates responses are asked for at once,
+    see get_valid_response
+    reprompt is called with full_prompt_by_user when a response is rejected and returns the new prompt and check, by
+    default the user enters a full prompt or the same prompt is asked again
     """
     #approve llm response from user
-    while True:
-        response = get_llm_response(prompt)
-        print('-------------------------------------------')
-        print("Response from LLM: \n", response)
-        key = input("Is the response correct? (y/n): ")
-        if key == 'y':
-            return response
-        else:
-            key2 = input("Do you want to enter full prompt? (y/n):")
-            if key2 == 'y':
-                prompt = get_user_input_for_llm(function_dict, tree_dict, full_prompt_by_user=True)
+    #count the received responses per prompt so re-asking the same prompt does not get the cached response again
+    attempts = {}
+    # the rounds are the responses shown and input_seconds the time spent waiting on the user
+    with metrics.span('approval') as span:
+        while True:
+            print('-------------------------------------------')
+            print("Response from LLM: ")
+            response, reason = get_valid_response(prompt, check, candidates, attempts, response)
+            if reason is not None:
+                print(f"Warning: no response passed the checks, this one is rejected as {reason}")
+            span.add('rounds', 1)
+            asked = time.perf_counter()
+            key = input("Is the response correct? (y/n): ")
+            if key == 'y':
+                span.add('input_seconds', time.perf_counter() - asked)
+                return response
             else:
-                prompt = get_user_input_for_llm(function_dict, tree_dict,)
+                response = None
+                key2 = input("Do you want to enter full prompt? (y/n):")
+                if reprompt is not None:
+                    prompt, check = reprompt(key2 == 'y')
+                elif key2 == 'y':
+                    prompt = input('Enter the full prompt: ')
+                span.add('input_seconds', time.perf_counter() - asked)
 
     
-def update_callers_code(file_path, function_name, tree, prev_response, function_dict, tree_dict):
+def get_caller_prompt(function_name, function_def, caller_code):
+    """ 
+    Get the prompt asking the llm to update a caller to the new function definition
+    """
+    return (
+        f"The function definition for {function_name} has changed to the following:\n{function_def}\n"
+        f"Update the given caller code to reflect the changes in the function definition and to pass the argument properly to {function_name} function. Follow best coding practices and only return the updated code. Generate only the code output for the caller code.\nCaller code:\n{caller_code}"
+    )
+
+
+def update_callers_code(function_name, prev_response, symbol_index, project_graph, tree_dict, concurrency=1,
+                        context_lines=DEFAULT_CONTEXT_LINES, token_budget=DEFAULT_TOKEN_BUDGET, parameter=None, candidates=1):
     """ 
     update the code of the caller functions of the given function by prompting llm
+    only the call sites are sent, with context_lines lines around them, see update_call_sites
+    context_lines=None sends the whole code of every caller, one request per caller
+    with concurrency > 1 the prompts of all the callers are sent at once, see update_callers_code_concurrently
+    the responses whose calls do not pass the added parameter, and the required ones, are not shown, see get_caller_check
     """
-    #get callers' names and codes
-    callers_names = tree.get_callers(function_name)
-    callers_codes = tree.get_callers_function_code(function_name)
+    if context_lines is not None:
+        # a response is shown only if every call site is in it and passes the arguments
+        update_call_sites(function_name, symbol_index, project_graph, tree_dict,
+                          lambda i, request, check, response: get_approved_llm_response(
+                              request['prompt'], symbol_index, tree_dict, response, check, candidates),
+                          concurrency, context_lines, token_budget, parameter)
+        return
+    if concurrency > 1:
+        return update_callers_code_concurrently(function_name, symbol_index, project_graph, tree_dict, concurrency, parameter,
+                                                candidates)
+    symbol = symbol_index.lookup(function_name)[0]
+    tree1 = tree_dict[symbol['file_path']]
+    function_name = symbol['name']
+    #get callers' qualified names from the project call graph
+    callers_names = project_graph.get_callers(symbol['qualified_name'])
     # function_def = prev_response
-    tree1, file_path1 = get_tree_of_function(function_name, function_dict, tree_dict)
-    function_def = tree1.get_function_from_name(function_name)
-    # function_def = tree.get_function_from_name(function_name)
+    function_def = tree1.source.text(symbol['start_byte'], symbol['end_byte'])
     #prompt llm to edit code of each caller to fit the new function definition and update the arguments
-    for i in range(len(callers_codes)):
-        caller_code = callers_codes[i]
-        caller_name = callers_names[i]
-        prompt = (
-            f"The function definition for {function_name} has changed to the following:\n{function_def}\n"
-            f"Update the given caller code to reflect the changes in the function definition and to pass the argument properly to {function_name} function. Follow best coding practices and only return the updated code. Generate only the code output for the caller code.\nCaller code:\n{caller_code}"
-        )   
-        response = get_approved_llm_response(prompt, function_dict, tree_dict)
+    for caller_name in callers_names:
+        # look the caller up again as earlier edits in its file may have moved it
+        caller = symbol_index.lookup(caller_name)[0]
+        file_path = caller['file_path']
+        tree = tree_dict[file_path]
+        caller_code = tree.source.text(caller['start_byte'], caller['end_byte'])
+        prompt = get_caller_prompt(function_name, function_def, caller_code)
+        callees = get_callees(caller_name, symbol['qualified_name'], tree.source, project_graph)
+        check = get_caller_check(caller, caller_code, symbol, function_def, parameter, callees)
+        response = get_approved_llm_response(prompt, symbol_index, tree_dict, check=check, candidates=candidates)
         #update the modified function/code provided by lmm to the actuall code file
         editor = CodeEditor(file_path)
-        a = tree.get_st_and_end_points(caller_name)
-        editor.replace_code(a[0],a[1], response)
+        a = get_st_and_end_points_of_symbol(caller_name, symbol_index, tree)
+        edit = editor.replace_code(a[0],a[1], response)
         code = ''
-        with open(file_path, 'r') as file:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            code = file.read()
+        tree.update_tree(code, edit)
+        update_indexes(tree, symbol_index, project_graph)
+
+
+def update_callers_code_concurrently(function_name, symbol_index, project_graph, tree_dict, concurrency, parameter=None,
+                                     candidates=1):
+    """ 
+    update the code of the caller functions of the given function by sending all the prompts to the llm at once,
+    with at most concurrency requests in flight, and asking for approval as the responses arrive
+    the approved code is then written with a single transactional edit batch per file
+    """
+    symbol = symbol_index.lookup(function_name)[0]
+    function_def = tree_dict[symbol['file_path']].source.text(symbol['start_byte'], symbol['end_byte'])
+    callers = [symbol_index.lookup(caller_name)[0] for caller_name in project_graph.get_callers(symbol['qualified_name'])]
+    callers_code = [tree_dict[caller['file_path']].source.text(caller['start_byte'], caller['end_byte']) for caller in callers]
+    prompts = [get_caller_prompt(symbol['name'], function_def, caller_code) for caller_code in callers_code]
+    checks = [get_caller_check(caller, caller_code, symbol, function_def, parameter,
+                               get_callees(caller['qualified_name'], symbol['qualified_name'], tree_dict[caller['file_path']].source,
+                                           project_graph))
+              for caller, caller_code in zip(callers, callers_code)]
+    replacements = {}
+
+    async def approve_responses():
+        async for i, response in get_llm_responses(prompts, concurrency):
+            # ask for approval in a thread so the remaining requests keep being sent meanwhile
+            response = await asyncio.to_thread(get_approved_llm_response, prompts[i], symbol_index, tree_dict, response,
+                                               checks[i], candidates)
+            replacements.setdefault(callers[i]['file_path'], []).append((callers[i]['start_byte'], callers[i]['end_byte'], response))
+
+    asyncio.run(approve_responses())
+    apply_replacements(replacements, symbol_index, project_graph, tree_dict)
+
+
+def update_call_sites(function_name, symbol_index, project_graph, tree_dict, get_response, concurrency=1,
+                      context_lines=DEFAULT_CONTEXT_LINES, token_budget=DEFAULT_TOKEN_BUDGET, parameter=None):
+    """ 
+    update the calls to the given function by sending the llm only the lines of each call site and context_lines lines
+    around them, all the call sites of a file in one request of at most token_budget tokens
+    get_response is called with the index of a request, the request, the check of its responses (every call site must
+    be in it and pass the arguments) and its first response, or None if it is not received yet, and returns the response
+    to apply or None to leave the call sites of the request unchanged; with concurrency > 1 the first responses are
+    received at once and get_response is called in a thread as they arrive
+    the responses are mapped back to the byte ranges of the call sites and written with one edit batch per file
+    Returns the requests, see group_call_sites
+    """
+    symbol = symbol_index.lookup(function_name)[0]
+    function_def = tree_dict[symbol['file_path']].source.text(symbol['start_byte'], symbol['end_byte'])
+    call_sites = get_call_sites(symbol['qualified_name'], symbol_index, project_graph, tree_dict, context_lines)
+    requests = group_call_sites(symbol['name'], function_def, call_sites, token_budget, symbol_index.root)
+    count = sum(len(sites) for sites in call_sites.values())
+    print(f"Updating {count} call sites in {len(call_sites)} files with {len(requests)} requests")
+    replacements = {}
+    check_calls = get_call_arguments_check(symbol, function_def, parameter)
+
+    def apply_response(i, response):
+        request = requests[i]
+        # the response is parsed as received, the code of every call site may be fenced on its own
+        check = lambda response: '; '.join(get_call_site_replacements(request, response, symbol['name'], check_calls)[1]) or None
+        response = get_response(i, request, check, response)
+        if response is None:
+            return
+        file_replacements, rejected = get_call_site_replacements(request, response, symbol['name'], check_calls)
+        for reason in rejected:
+            print(f"Skipping {reason} in {request['file_path']}")
+        replacements.setdefault(request['file_path'], []).extend(file_replacements)
+
+    async def approve_responses():
+        async for i, response in get_llm_responses([request['prompt'] for request in requests], concurrency):
+            # ask for approval in a thread so the remaining requests keep being sent meanwhile
+            await asyncio.to_thread(apply_response, i, response)
+
+    with metrics.span('call_sites', files=len(call_sites), calls=count, requests=len(requests)):
+        if concurrency > 1:
+            asyncio.run(approve_responses())
+        else:
+            for i in range(len(requests)):
+                apply_response(i, None)
+    apply_replacements(replacements, symbol_index, project_graph, tree_dict)
+    return requests
+
+
+def get_call_arguments_check(symbol, function_def, parameter=None):
+    """ 
+    Get the check of the calls to the function in some code, given the code and the callee expressions the function is
+    called through: they must pass the added parameter and the required ones of its new definition function_def,
+    see check_call_arguments
+    """
+    # only a function defined directly in a class body binds its first parameter, not one nested in a method
+    method = symbol['class_name'] is not None and symbol['qualified_name'] == f"{symbol['class_name']}.{symbol['name']}"
+    return lambda code, callees: check_call_arguments(code, callees, function_def, parameter, method)
+
+
+def get_function_check(name, parameter=None):
+    """ 
+    Get the check of a response with the new code of the function: without its code fences it must be a single
+    function named name with the added parameter, see check_function_code
+    """
+    editor = CodeEditor(None)
+    return lambda response: check_function_code(editor.remove_triple_backticks(response), name, parameter=parameter)
+
+
+def get_caller_check(caller, caller_code, symbol, function_def, parameter=None, callees=None):
+    """ 
+    Get the check of a response with the new code of a caller: without its code fences it must keep the name and
+    parameters of the caller, and its calls to the function through the callees expressions recorded in the caller
+    (see get_callees) must pass the arguments, see get_call_arguments_check
+    """
+    func_node, _ = get_function_definition(caller_code)
+    params = get_parameter_names(func_node) if func_node is not None else None
+    check_calls = get_call_arguments_check(symbol, function_def, parameter)
+    callees = callees or [symbol['name']]
+    editor = CodeEditor(None)
+
+    def check(response):
+        code = editor.remove_triple_backticks(response)
+        return check_function_code(code, caller['name'], params=params) or check_calls(code, callees)
+    return check
+
+
+def apply_replacements(replacements, symbol_index, project_graph, tree_dict):
+    """ 
+    Write the (start_byte, end_byte, code) replacements of each file path, all the files or none of them,
+    and update the trees, the symbol index and the project call graph incrementally
+    """
+    # get the trees before writing as the lazily built ones have to start from the old code
+    trees = {file_path: tree_dict[file_path] for file_path in replacements}
+    batches = []
+    for file_path, file_replacements in replacements.items():
+        batch = CodeEditor(file_path).begin_batch()
+        for start_byte, end_byte, response in drop_nested_replacements(file_replacements):
+            batch.add(start_byte, end_byte, response)
+        batches.append(batch)
+    edits = apply_batches(batches)
+    for file_path, tree in trees.items():
+        with open(file_path, 'r', encoding='utf-8') as file:
             code = file.read()
-        tree.update_tree(code)
+        tree.update_tree(code, edits[file_path])
+        update_indexes(tree, symbol_index, project_graph)
+
+
+def drop_nested_replacements(replacements):
+    """ 
+    Drop the replacements of callers nested in another replaced caller, the code of the outer one already covers them
+    """
+    kept = []
+    for start_byte, end_byte, response in sorted(replacements, key=lambda replacement: (replacement[0], -replacement[1])):
+        if kept and start_byte < kept[-1][1]:
+            print(f"Skipping the nested caller at byte {start_byte}, it is replaced with its enclosing caller")
+            continue
+        kept.append((start_byte, end_byte, response))
+    return kept
+
+
+def positive_int(value):
+    """ 
+    Parse a command line value that must be an integer of at least 1
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
             
     
 
                 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transform the files of a repository using llm.")
+    parser.add_argument('repo_url', nargs='?', help="url of the repository, asked for if not given")
+    parser.add_argument('--no-graphs', action='store_true', help="do not draw the call graphs")
+    parser.add_argument('--graph-output', default=None, help="export the updated call graph to this .html, .dot or .json file instead of displaying it")
+    parser.add_argument('--collapse', choices=['module', 'class'], default=None, help="draw one node per module or class")
+    parser.add_argument('--workers', type=int, default=None, help="processes parsing the files, all the cores by default")
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv("LLM_CONCURRENCY", "1")),
+                        help="caller update requests sent to the llm at once")
+    parser.add_argument('--context-lines', type=int, default=DEFAULT_CONTEXT_LINES,
+                        help="lines sent around every call site to update")
+    parser.add_argument('--token-budget', type=int, default=DEFAULT_TOKEN_BUDGET,
+                        help="tokens of a caller update request, the call sites of a file are grouped up to it")
+    parser.add_argument('--whole-callers', action='store_true',
+                        help="send the whole code of every caller in its own request instead of the call sites")
+    parser.add_argument('--fast', action='store_true',
+                        help="make or update a shallow sparse clone of the Python files through a local mirror")
+    parser.add_argument('--mirror-dir', default=None, help="directory of the mirrors of --fast, .git_mirrors by default")
+    parser.add_argument('--candidates', type=positive_int, default=int(os.getenv("LLM_CANDIDATES", "1")),
+                        help="responses asked for at once, the first one passing the checks is shown")
+    parser.add_argument('--daemon', nargs='?', const='', default=None, metavar='SOCKET',
+                        help="load the indexes from the daemon watching the clone, on its default socket if none is given")
+    parser.add_argument('--trace', default=None, help="write the timings of every stage to this JSON file")
+    parser.add_argument('--metrics', default=None, help="write the stage metrics to this file in the Prometheus text format")
+    args = parser.parse_args()
+    if args.trace or args.metrics:
+        metrics.enable()
+
     # code to clone repo and transform files
-    github_api = GitHubAPI()
-    repo_url = input("provide the url to the git repo: ")
+    repo_url = args.repo_url or input("provide the url to the git repo: ")
     # repo_url = "https://github.com/t-gandhi-19/example"  
-    cloned_path = github_api.clone_repo(repo_url)
-    transform(cloned_path)
+    # local repositories are cloned without a token, e.g. to try the fast clones offline
+    github_api = GitHubAPI(require_token=not is_local_source(repo_url))
+    cloned_path = github_api.clone_repo(repo_url, fast=args.fast, mirror_dir=args.mirror_dir)
+    if cloned_path is None:
+        raise SystemExit(1)
+    # an existing clone is reused as is and a fast clone only changes the files of the new commit, so the records of
+    # the other files are already cached
+    cache = ParseCache()
+    daemon = None if args.daemon is None else args.daemon or get_socket_path(cloned_path)
+    transform(cloned_path, args.workers, cache, args.concurrency, not args.no_graphs, args.graph_output, args.collapse,
+              None if args.whole_callers else args.context_lines, args.token_budget, daemon, args.candidates)
+    cache.close()
+    if args.trace:
+        metrics.write_trace(args.trace)
+    if args.metrics:
+        metrics.write_prometheus(args.metrics)
     
 
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import threading
+
+# recording is off unless enable() is called or METRICS=1, then every span is kept in events and passed to the hooks
+enabled = os.getenv("METRICS", "0") == "1"
+events = []
+hooks = []
+lock = threading.Lock()
+# wall clock and perf counter time of the start of the trace, the spans are timed relative to it
+trace_start = (time.time(), time.perf_counter())
+# numeric span fields summed into counters, the rest are only kept in the JSON trace
+COUNTERS = ['bytes_read', 'bytes_written', 'files', 'functions', 'calls', 'nodes', 'edges', 'input_tokens',
+            'output_tokens', 'cached', 'rounds', 'input_seconds', 'requests']
+PREFIX = 'function_updater'
+
+
+class Span:
+    """
+    Time of one run of a pipeline stage, with fields such as bytes or tokens set while it runs.
+    Use it as a context manager, the span is recorded when the block exits, with its error if it raised.
+    """
+    def __init__(self, stage, fields):
+        self.stage = stage
+        self.fields = fields
+        self.start = None
+
+    def set(self, **fields):
+        """
+        Set fields of the span.
+        """
+        self.fields.update(fields)
+
+    def add(self, field, value):
+        """
+        Add value to a numeric field of the span.
+        """
+        self.fields[field] = self.fields.get(field, 0) + value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        event = {'stage': self.stage, 'start': self.start - trace_start[1], 'seconds': end - self.start,
+                 'thread': threading.current_thread().name, **self.fields}
+        if exc_type is not None:
+            event['error'] = exc_type.__name__
+        record(event)
+        return False
+
+
+class NullSpan:
+    """
+    Span returned while recording is off, it does nothing so the instrumented code costs a function call per stage.
+    """
+    def set(self, **fields):
+        pass
+
+    def add(self, field, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(stage, **fields):
+    """
+    Get a span timing a run of the stage, e.g. `with span('parse', files=10) as s: ...; s.set(bytes_read=n)`.
+    """
+    if not enabled:
+        return NULL_SPAN
+    return Span(stage, fields)
+
+
+def record(event):
+    """
+    Keep a finished span and pass it to every hook. A failing hook is reported and does not stop the others.
+    """
+    with lock:
+        events.append(event)
+        current_hooks = list(hooks)
+    for hook in current_hooks:
+        try:
+            hook(event)
+        except Exception as e:
+            print(f"Error in metrics hook {getattr(hook, '__name__', hook)}: {e}")
+
+
+def enable():
+    """
+    Start recording the spans.
+    """
+    global enabled
+    enabled = True
+
+
+def disable():
+    """
+    Stop recording the spans, the ones already recorded are kept.
+    """
+    global enabled
+    enabled = False
+
+
+def add_hook(hook):
+    """
+    Add a custom sink called with the dict of every span as it finishes, from the thread that ran it, and enable
+    the recording. The dict has the 'stage', its 'start' in seconds since the trace started, the 'seconds' it took,
+    the 'thread' and the fields of the span.
+    """
+    with lock:
+        hooks.append(hook)
+    enable()
+
+
+def remove_hook(hook):
+    """
+    Remove a sink added with add_hook.
+    """
+    with lock:
+        hooks.remove(hook)
+
+
+def reset():
+    """
+    Drop the recorded spans and restart the trace clock.
+    """
+    global trace_start
+    with lock:
+        events.clear()
+        trace_start = (time.time(), time.perf_counter())
+
+
+def summarize():
+    """
+    Get, for every stage, the number of runs, errors, total seconds and the sum of each counter field.
+    """
+    with lock:
+        current_events = list(events)
+    stages = {}
+    for event in current_events:
+        summary = stages.setdefault(event['stage'], {'count': 0, 'errors': 0, 'seconds': 0.0})
+        summary['count'] += 1
+        summary['errors'] += 'error' in event
+        summary['seconds'] += event['seconds']
+        for field in COUNTERS:
+            value = event.get(field)
+            # a True flag such as cached counts as one
+            if isinstance(value, (int, float)):
+                summary[field] = summary.get(field, 0) + value
+    return stages
+
+
+def get_trace():
+    """
+    Get the structured trace: its start time, every recorded span in the order they finished and the summary per stage.
+    """
+    with lock:
+        current_events = list(events)
+    return {'started': trace_start[0], 'pid': os.getpid(), 'events': current_events, 'stages': summarize()}
+
+
+def write_trace(path):
+    """
+    Write the trace to a JSON file.
+    """
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(json.dumps(get_trace(), indent=2))
+
+
+def prometheus_text():
+    """
+    Get the summary in the Prometheus text exposition format, one counter family per measure labelled by stage.
+    """
+    stages = summarize()
+    families = [('stage_runs_total', 'count', "Runs of the stage"),
+                ('stage_errors_total', 'errors', "Runs of the stage that raised an error"),
+                ('stage_seconds_total', 'seconds', "Time spent in the stage")]
+    families += [(f"{field}_total", field, f"Sum of {field.replace('_', ' ')} over the runs of the stage")
+                 for field in COUNTERS]
+    lines = []
+    for name, field, description in families:
+        samples = [(stage, summary[field]) for stage, summary in sorted(stages.items()) if field in summary]
+        if not samples:
+            continue
+        lines.append(f"# HELP {PREFIX}_{name} {description}")
+        lines.append(f"# TYPE {PREFIX}_{name} counter")
+        for stage, value in samples:
+            lines.append(f'{PREFIX}_{name}{{stage="{stage}"}} {float(value)!r}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path):
+    """
+    Write the Prometheus text dump to a file, e.g. for the textfile collector of the node exporter.
+    """
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(prometheus_text())
+
+
+def print_summary():
+    """
+    Print the time, runs and main counters of every stage.
+    """
+    for stage, summary in summarize().items():
+        counters = ', '.join(f"{field}: {summary[field]:g}" for field in COUNTERS if field in summary)
+        print(f"{stage:<24} {summary['count']:>5} runs {summary['seconds']:>9.3f}s" + (f"  {counters}" if counters else ''))
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import sqlite3
+from importlib.metadata import version, PackageNotFoundError
+
+# bump when the layout of CreateTree.get_file_record changes
+RECORD_VERSION = 2
+
+
+def grammar_version():
+    """
+    Get the version string of the parser and grammar the records were built with.
+    """
+    versions = []
+    for package in ('tree-sitter', 'tree-sitter-python'):
+        try:
+            versions.append(f"{package}={version(package)}")
+        except PackageNotFoundError:
+            versions.append(f"{package}=unknown")
+    return ';'.join(versions + [f"record={RECORD_VERSION}"])
+
+
+def content_hash(data):
+    """
+    Get the hash of the content of a file.
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class ParseCache:
+    """
+    On disk SQLite cache of the file records (functions and call edges) keyed by file path, content hash and grammar version,
+    so a restart on an unchanged clone only parses the new or changed files.
+    The least recently used records are evicted once the cache grows past max_bytes.
+    """
+    def __init__(self, path=None, max_bytes=256 * 1024 * 1024):
+        self.path = path or os.path.join(os.getcwd(), '.parse_cache.sqlite')
+        self.max_bytes = max_bytes
+        self.grammar = grammar_version()
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "file_path TEXT, content_hash TEXT, grammar TEXT, record BLOB, size INTEGER, last_used REAL, "
+            "PRIMARY KEY (file_path, content_hash, grammar))"
+        )
+        self.connection.commit()
+
+    def get(self, file_path, file_hash):
+        """
+        Get the cached record of the file with the given content hash, or None.
+        """
+        row = self.connection.execute(
+            "SELECT record FROM records WHERE file_path = ? AND content_hash = ? AND grammar = ?",
+            (file_path, file_hash, self.grammar)
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute(
+            "UPDATE records SET last_used = ? WHERE file_path = ? AND content_hash = ? AND grammar = ?",
+            (time.time(), file_path, file_hash, self.grammar)
+        )
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, file_path, file_hash, record):
+        """
+        Store the record of the file, replacing the records of its older contents.
+        """
+        data = zlib.compress(json.dumps(record, separators=(',', ':')).encode('utf-8'))
+        self.connection.execute("DELETE FROM records WHERE file_path = ?", (file_path,))
+        self.connection.execute(
+            "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?)",
+            (file_path, file_hash, self.grammar, data, len(data), time.time())
+        )
+
+    def evict(self):
+        """
+        Delete the least recently used records until the cache fits in max_bytes.
+        """
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM records").fetchone()[0]
+        if total > self.max_bytes:
+            rows = self.connection.execute("SELECT rowid, size FROM records ORDER BY last_used").fetchall()
+            stale = []
+            for rowid, size in rows:
+                if total <= self.max_bytes:
+                    break
+                stale.append((rowid,))
+                total -= size
+            self.connection.executemany("DELETE FROM records WHERE rowid = ?", stale)
+        self.connection.commit()
+
+    def invalidate(self, file_path=None):
+        """
+        Drop the cached record of a file, or the whole cache if no file is given.
+        """
+        if file_path is None:
+            self.connection.execute("DELETE FROM records")
+        else:
+            self.connection.execute("DELETE FROM records WHERE file_path = ?", (file_path,))
+        self.connection.commit()
+
+    def close(self):
+        """
+        Commit the pending changes and close the database.
+        """
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,124 @@
+from compact_graph import CompactCallGraph
+
+
+class ProjectCallGraph:
+    """
+    Call graph of the whole repository keyed by the qualified names of the SymbolIndex.
+    Callee names are resolved through the imports of each file, 'self.'/'cls.' method calls and the enclosing scopes,
+    so finding every caller of a function is a single reverse-edge lookup whatever module it lives in.
+    The graph is a CompactCallGraph with one call row per call site, see to_networkx to draw it.
+    """
+    def __init__(self, symbol_index):
+        self.symbol_index = symbol_index
+        self.graph = CompactCallGraph()
+        self.by_file = {}
+
+    def resolve_import(self, module, file_path):
+        """
+        Get the absolute dotted path of a possibly relative module imported in the given file.
+        """
+        level = len(module) - len(module.lstrip('.'))
+        if level == 0:
+            return module
+        package = self.symbol_index.module_name(file_path).split('.')
+        if not file_path.endswith('__init__.py'):
+            package = package[:-1]
+        if level > 1:
+            package = package[:-(level - 1)]
+        return '.'.join(part for part in package + [module.lstrip('.')] if part)
+
+    def get_aliases(self, imports, file_path):
+        """
+        Get the mapping from the names bound by the imports of a file to the qualified names they refer to.
+        """
+        aliases = {}
+        for local_name, module, name in imports:
+            if name is None:
+                aliases[local_name] = module
+            else:
+                aliases[local_name] = '.'.join(part for part in (self.resolve_import(module, file_path), name) if part)
+        return aliases
+
+    def resolve_callee(self, callee, scopes, class_name, aliases):
+        """
+        Get the qualified name of the function called by the callee expression, or None if it is not defined in the repository.
+        """
+        parts = callee.split('.')
+        if not all(part.isidentifier() for part in parts):
+            return None
+        candidates = []
+        if class_name and parts[0] in ('self', 'cls') and len(parts) > 1:
+            candidates.append('.'.join([class_name] + parts[1:]))
+        candidates.extend('.'.join(part for part in (scope, callee) if part) for scope in scopes)
+        if parts[0] in aliases:
+            candidates.append('.'.join([aliases[parts[0]]] + parts[1:]))
+        symbols = self.symbol_index.symbols
+        for candidate in candidates:
+            if candidate in symbols:
+                return candidate
+            # calling a class runs its constructor
+            if f"{candidate}.__init__" in symbols:
+                return f"{candidate}.__init__"
+        return None
+
+    def update_file(self, record):
+        """
+        (Re)build the edges going out of the functions of a file from its record, see CreateTree.get_file_record.
+        The SymbolIndex must be up to date.
+        """
+        file_path = record['file_path']
+        self.remove_file(file_path)
+        module = self.symbol_index.module_name(file_path)
+        aliases = self.get_aliases(record['imports'], file_path)
+        callers = set()
+        for function in record['functions']:
+            caller = '.'.join(part for part in (module, function['scope_name']) if part)
+            class_name = '.'.join(part for part in (module, function['class_name']) if part) if function['class_name'] else None
+            # enclosing function scopes from the innermost outwards, then the module; class bodies are not visible
+            scopes = ['.'.join(part for part in (module, scope) if part) for scope in function['scopes']] + [module]
+            self.graph.add_node(caller)
+            callers.add(caller)
+            for callee_text, start_byte, end_byte in function['calls']:
+                callee = self.resolve_callee(callee_text, scopes, class_name, aliases)
+                if callee is not None:
+                    self.graph.add_call(caller, callee, start_byte, end_byte)
+        self.by_file[file_path] = callers
+
+    def update_files(self, records):
+        """
+        Update the edges of many files, see update_file, then index their calls at once so the caller and callee lookups
+        do not scan them as recent calls.
+        """
+        for record in records:
+            self.update_file(record)
+        self.graph.consolidate()
+
+    def remove_file(self, file_path):
+        """
+        Remove the edges going out of the functions of the given file, and the functions no longer called nor defined.
+        """
+        callers = [caller for caller in self.by_file.pop(file_path, set()) if caller in self.graph]
+        self.graph.remove_calls_from(callers)
+        for caller in callers:
+            if self.graph.in_degree(caller) == 0 and caller not in self.symbol_index.symbols:
+                self.graph.remove_node(caller)
+
+    def get_callers(self, qualified_name):
+        """
+        Get the qualified names of the functions that call the given function.
+        """
+        if qualified_name not in self.graph:
+            return []
+        return self.graph.predecessors(qualified_name)
+
+    def get_call_ranges(self, caller, callee):
+        """
+        Get the (start byte, end byte) of every call from caller to callee, in the file of the caller.
+        """
+        return [(start_byte, end_byte) for start_byte, end_byte, _, _ in self.graph.get_calls(caller, callee)]
+
+    def to_networkx(self):
+        """
+        Get the call graph as a networkx DiGraph, for visualization only.
+        """
+        return self.graph.to_networkx()
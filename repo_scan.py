@@ -0,0 +1,114 @@
+import os
+import fnmatch
+from concurrent.futures import ProcessPoolExecutor
+from construct_ast import CreateTree
+from parse_cache import content_hash
+
+
+class GitIgnore:
+    """
+    Minimal matcher for the patterns of the .gitignore files found while walking a repository.
+    Supports comments, negation with '!', directory only patterns ending with '/' and patterns anchored by a '/'.
+    """
+    def __init__(self):
+        self.rules = []
+
+    def add_file(self, gitignore_path):
+        """
+        Add the patterns of a .gitignore file, relative to the directory containing it.
+        """
+        base = os.path.dirname(gitignore_path)
+        with open(gitignore_path, 'r', encoding='utf-8', errors='replace') as file:
+            for line in file:
+                pattern = line.strip()
+                if not pattern or pattern.startswith('#'):
+                    continue
+                negate = pattern.startswith('!')
+                if negate:
+                    pattern = pattern[1:]
+                dir_only = pattern.endswith('/')
+                pattern = pattern.rstrip('/')
+                anchored = '/' in pattern
+                pattern = pattern.lstrip('/')
+                self.rules.append((base, pattern, negate, dir_only, anchored))
+
+    def is_ignored(self, path, is_dir):
+        """
+        Check if the path is ignored, the last matching pattern wins.
+        """
+        ignored = False
+        for base, pattern, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            rel_path = os.path.relpath(path, base)
+            if rel_path.startswith('..'):
+                continue
+            rel_path = rel_path.replace(os.sep, '/')
+            target = rel_path if anchored else os.path.basename(path)
+            if fnmatch.fnmatch(target, pattern):
+                ignored = not negate
+        return ignored
+
+
+def scan_repository(directory):
+    """
+    Walk the directory once and get the directories and the paths of the python files that are not ignored by git.
+    """
+    gitignore = GitIgnore()
+    directories = []
+    filepaths = []
+    for root, dirs, files in os.walk(directory):
+        directories.append(root)
+        if '.gitignore' in files:
+            gitignore.add_file(os.path.join(root, '.gitignore'))
+        dirs[:] = sorted(d for d in dirs if d != '.git' and not gitignore.is_ignored(os.path.join(root, d), True))
+        for file in sorted(files):
+            filepath = os.path.join(root, file)
+            if file.endswith(".py") and not gitignore.is_ignored(filepath, False):
+                filepaths.append(filepath)
+    return directories, filepaths
+
+
+def scan_python_files(directory):
+    """
+    Walk the directory once and get the paths of the python files that are not ignored by git.
+    """
+    return scan_repository(directory)[1]
+
+
+def parse_file_record(filepath):
+    """
+    Parse a file and get its record (functions and calls), run in the worker processes.
+    """
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return CreateTree(f.read(), filepath).get_file_record()
+
+
+def parse_files(filepaths, workers=None, cache=None):
+    """
+    Parse the files across a pool of worker processes and get their records in the same order.
+    With workers=1 the files are parsed in this process. If a ParseCache is given only the files whose content
+    changed since they were cached are parsed, the files are keyed by the content_hash of their bytes.
+    """
+    records = [None] * len(filepaths)
+    hashes = {}
+    if cache is not None:
+        for i, filepath in enumerate(filepaths):
+            with open(filepath, 'rb') as f:
+                hashes[filepath] = content_hash(f.read())
+            records[i] = cache.get(filepath, hashes[filepath])
+    missing = [i for i, record in enumerate(records) if record is None]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(missing) < 2:
+        parsed = [parse_file_record(filepaths[i]) for i in missing]
+    else:
+        chunksize = max(1, len(missing) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = list(executor.map(parse_file_record, [filepaths[i] for i in missing], chunksize=chunksize))
+    for i, record in zip(missing, parsed):
+        records[i] = record
+        if cache is not None:
+            cache.put(filepaths[i], hashes[filepaths[i]], record)
+    if cache is not None:
+        cache.evict()
+    return records
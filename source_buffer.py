@@ -0,0 +1,59 @@
+from array import array
+from bisect import bisect_right
+from tree_sitter import Point
+
+
+class SourceBuffer:
+    """
+    UTF-8 bytes of one source file together with the byte offset of every line start.
+    Built once per file so points and byte ranges from tree-sitter can be mapped and sliced
+    without rescanning the whole file.
+    """
+    def __init__(self, code):
+        if isinstance(code, str):
+            code = code.encode("utf-8")
+        self.data = bytes(code)
+        self.view = memoryview(self.data)
+        self.line_starts = self.index_line_starts(self.data)
+
+    @staticmethod
+    def index_line_starts(data):
+        """
+        Return the byte offset of the start of every line. Tree-sitter only treats '\\n' as a row break.
+        """
+        line_starts = array('Q', [0])
+        pos = data.find(b"\n")
+        while pos != -1:
+            line_starts.append(pos + 1)
+            pos = data.find(b"\n", pos + 1)
+        return line_starts
+
+    def __len__(self):
+        return len(self.data)
+
+    def point_to_byte_offset(self, point):
+        """
+        Convert a Point(row, column) to a byte offset. Tree-sitter columns are already byte columns.
+        """
+        if point.row >= len(self.line_starts):
+            return len(self.data)
+        return min(self.line_starts[point.row] + point.column, len(self.data))
+
+    def byte_offset_to_point(self, offset):
+        """
+        Convert a byte offset to a Point(row, column).
+        """
+        row = bisect_right(self.line_starts, offset) - 1
+        return Point(row, offset - self.line_starts[row])
+
+    def text(self, start_byte, end_byte):
+        """
+        Decode the source between start_byte and end_byte.
+        """
+        return str(self.view[start_byte:end_byte], "utf-8")
+
+    def text_between_points(self, start_point, end_point):
+        """
+        Decode the source between start_point and end_point.
+        """
+        return self.text(self.point_to_byte_offset(start_point), self.point_to_byte_offset(end_point))
@@ -0,0 +1,76 @@
+import os
+
+
+class SymbolIndex:
+    """
+    Repository wide index of function definitions.
+    Maps qualified names (module path, classes and function name joined by '.') to the file, byte range and call graph
+    node of the function, and bare function names to all qualified names sharing them.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.symbols = {}
+        self.by_name = {}
+        self.by_file = {}
+
+    def module_name(self, file_path):
+        """
+        Get the dotted module path of a file relative to the root of the repository.
+        """
+        rel_path = os.path.splitext(os.path.relpath(file_path, self.root))[0]
+        parts = [part for part in rel_path.split(os.sep) if part not in ('', '.')]
+        if parts and parts[-1] == '__init__':
+            parts.pop()
+        return '.'.join(parts)
+
+    def update_file(self, record):
+        """
+        (Re)index all the functions defined in a file from its record, see CreateTree.get_file_record.
+        """
+        file_path = record['file_path']
+        self.remove_file(file_path)
+        module = self.module_name(file_path)
+        qualified_names = {}
+        for function in record['functions']:
+            name = function['name']
+            qualified_name = '.'.join(part for part in (module, function['scope_name']) if part)
+            self.symbols[qualified_name] = {
+                'qualified_name': qualified_name,
+                'name': name,
+                'class_name': '.'.join(part for part in (module, function['class_name']) if part) if function['class_name'] else None,
+                'file_path': file_path,
+                'start_byte': function['start_byte'],
+                'end_byte': function['end_byte'],
+            }
+            if qualified_name not in qualified_names:
+                self.by_name.setdefault(name, []).append(qualified_name)
+                qualified_names[qualified_name] = None
+        self.by_file[file_path] = list(qualified_names)
+
+    def remove_file(self, file_path):
+        """
+        Remove all the functions of the given file from the index.
+        """
+        for qualified_name in self.by_file.pop(file_path, []):
+            symbol = self.symbols.pop(qualified_name, None)
+            if symbol is None:
+                continue
+            names = self.by_name.get(symbol['name'], [])
+            if qualified_name in names:
+                names.remove(qualified_name)
+            if not names:
+                self.by_name.pop(symbol['name'], None)
+
+    def lookup(self, name):
+        """
+        Get the records of the functions matching a qualified name, or all the functions with the given bare name.
+        """
+        if name in self.symbols:
+            return [self.symbols[name]]
+        return [self.symbols[qualified_name] for qualified_name in self.by_name.get(name, [])]
+
+    def files(self):
+        """
+        Get the list of indexed files.
+        """
+        return list(self.by_file.keys())
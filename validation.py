@@ -0,0 +1,150 @@
+from tree_sitter import Parser
+from construct_ast import PY_LANGUAGE
+
+
+def get_function_definition(code):
+    """
+    Parse the llm provided code and get its single top level function definition.
+    Returns (function node, None), or (None, reason) if the code is not exactly one function definition.
+    """
+    root = Parser(PY_LANGUAGE).parse(code.encode('utf-8')).root_node
+    if root.has_error:
+        return None, "the code does not parse"
+    statements = [node for node in root.named_children if node.type != 'comment']
+    if len(statements) != 1:
+        return None, f"expected a single function definition, got {len(statements)} statements"
+    node = statements[0]
+    if node.type == 'decorated_definition':
+        node = node.child_by_field_name('definition')
+    if node is None or node.type != 'function_definition':
+        return None, "the code is not a function definition"
+    return node, None
+
+
+def get_parameter_names(func_node):
+    """
+    Get the names of the parameters of the function, without the '*' and '**' of variadic ones.
+    """
+    names = []
+    for param in func_node.child_by_field_name('parameters').named_children:
+        if param.type == 'identifier':
+            names.append(param.text.decode('utf-8'))
+        elif param.child_by_field_name('name') is not None:
+            names.append(param.child_by_field_name('name').text.decode('utf-8'))
+        else:
+            identifiers = [child for child in param.named_children if child.type == 'identifier']
+            if identifiers:
+                names.append(identifiers[0].text.decode('utf-8'))
+    return names
+
+
+def check_function_code(code, name, parameter=None, params=None):
+    """
+    Check that the llm provided code is a single function definition named name, which has the added parameter
+    and/or exactly the given parameters.
+    Returns None if the code is accepted, else the reason it is rejected.
+    """
+    func_node, reason = get_function_definition(code)
+    if func_node is None:
+        return reason
+    func_name = func_node.child_by_field_name('name').text.decode('utf-8')
+    if func_name != name:
+        return f"the function is named '{func_name}' instead of '{name}'"
+    names = get_parameter_names(func_node)
+    if parameter is not None and parameter not in names:
+        return f"the parameter '{parameter}' is missing"
+    if params is not None and names != params:
+        return f"the parameters changed from {params} to {names}"
+    return None
+
+
+def get_parameters(func_node, method=False):
+    """
+    Get the (name, position, required) of every named parameter of the function, position being None for keyword-only
+    parameters. method=True leaves out the first parameter, bound to the instance or class.
+    """
+    parameters = []
+    position = 0
+    keyword_only = False
+    for param in func_node.child_by_field_name('parameters').named_children:
+        if param.type in ('list_splat_pattern', 'keyword_separator') or (
+                param.type == 'typed_parameter' and param.named_children[0].type == 'list_splat_pattern'):
+            keyword_only = True
+            continue
+        if param.type == 'identifier':
+            name = param.text.decode('utf-8')
+        elif param.child_by_field_name('name') is not None:
+            name = param.child_by_field_name('name').text.decode('utf-8')
+        elif param.type == 'typed_parameter' and param.named_children[0].type == 'identifier':
+            name = param.named_children[0].text.decode('utf-8')
+        else:
+            continue
+        parameters.append((name, None if keyword_only else position, param.type not in ('default_parameter', 'typed_default_parameter')))
+        position += not keyword_only
+    if method and parameters and parameters[0][1] == 0:
+        parameters = [(name, None if position is None else position - 1, required) for name, position, required in parameters[1:]]
+    return parameters
+
+
+def get_calls(root, callees):
+    """
+    Get the call nodes under root calling one of the callee expressions, e.g. 'lg' or 'logger.log', compared without
+    whitespace.
+    """
+    calls = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node.type == 'call':
+            callee = b''.join(node.child_by_field_name('function').text.split()).decode('utf-8')
+            if callee in callees:
+                calls.append(node)
+        stack.extend(reversed(node.children))
+    return calls
+
+
+def is_static(func_node):
+    """
+    Check if the function is decorated with staticmethod.
+    """
+    parent = func_node.parent
+    if parent is None or parent.type != 'decorated_definition':
+        return False
+    return any(decorator.text.strip() == b'@staticmethod' for decorator in parent.named_children if decorator.type == 'decorator')
+
+
+def check_call_arguments(code, callees, function_code, parameter=None, method=False):
+    """
+    Check that every call through one of the callee expressions in the llm provided code passes the added parameter
+    and every parameter without a default of the new function definition function_code, by position or keyword.
+    The callees are the expressions the function is called through at the call sites, see call_context.get_callee.
+    method=True is for a function defined in a class body, its first parameter is bound by the call unless it is a
+    staticmethod. A call unpacking *args or **kwargs is accepted as is. The code may be a whole caller or only some of
+    its lines.
+    Returns None if the code is accepted, else the reason it is rejected.
+    """
+    func_node, reason = get_function_definition(function_code)
+    if func_node is None:
+        return f"the new function definition is not valid: {reason}"
+    parameters = get_parameters(func_node, method and not is_static(func_node))
+    needed = [(param, position) for param, position, required in parameters if required or param == parameter]
+    calls = get_calls(Parser(PY_LANGUAGE).parse(code.encode('utf-8')).root_node, callees)
+    if not calls:
+        return f"the code does not call {' or '.join(callees)}"
+    for call in calls:
+        name = b''.join(call.child_by_field_name('function').text.split()).decode('utf-8')
+        arguments = call.child_by_field_name('arguments')
+        if arguments.type == 'generator_expression':
+            positional, keywords = 1, set()
+        else:
+            args = [arg for arg in arguments.named_children if arg.type != 'comment']
+            if any(arg.type in ('list_splat', 'dictionary_splat') for arg in args):
+                continue
+            keywords = {arg.child_by_field_name('name').text.decode('utf-8') for arg in args if arg.type == 'keyword_argument'}
+            positional = sum(arg.type != 'keyword_argument' for arg in args)
+        missing = [param for param, position in needed
+                   if param not in keywords and (position is None or position >= positional)]
+        if missing:
+            line = call.start_point[0] + 1
+            return f"the call to {name} on line {line} does not pass {', '.join(repr(param) for param in missing)}"
+    return None